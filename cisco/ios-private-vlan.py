@@ -15,6 +15,8 @@ import sys
 from netmiko import ConnectHandler
 import numpy
 
+from private_vlan_bulk import get_capabilities
+
 
 # NOTE SVI creation is not included in this script.
 # NOTE Switchport modes for host and promiscuous mode is not included in this script.
@@ -24,16 +26,6 @@ import numpy
 # TODO Create more verbose output to see a response from the switch.
 
 
-def get_vtp_mode(net_connect):
-    # Check if vtp is transparent.
-    vtp = (net_connect.send_command("show vtp status"))
-
-    if "Transparent" in vtp:
-        return True
-    else:
-        return False
-
-
 def check_vlan_exists(net_connect, vlan):
     # Check if VLAN already exists.
     for row in vlan:
@@ -82,6 +74,10 @@ def main():
     parser.add_argument("-p", "--primary", type=int, metavar='', required=True, help="Primary VLAN ID")
     parser.add_argument("-c", "--community", type=int, metavar='', required=True, help="Community VLAN ID")
     parser.add_argument("-i", "--isolated", type=int, metavar='', required=True, help="Isolated VLAN ID")
+    parser.add_argument("--cache-ttl", type=int, default=86400, metavar='',
+            help="Seconds to trust cached VTP/feature/version probes, 0 to disable (default 86400).")
+    parser.add_argument("--refresh", action="store_true",
+            help="Ignore the capability cache and probe the switch again.")
     args = parser.parse_args()
 
     # Device info.
@@ -95,10 +91,11 @@ def main():
     # Initiate the SSH connection.
     net_connect = ConnectHandler(**cisco_switch)
 
-    # Check if VTP mode is transparent.
-    vtp_transparent = get_vtp_mode(net_connect)
+    # Check if VTP mode is transparent or off, cached between runs.
+    capabilities = get_capabilities(net_connect, args.host, 'ios', args.cache_ttl, args.refresh)
+    vtp_transparent = capabilities['vtp']
     if vtp_transparent is True:
-        print("VTP mode is transparent.\n Proceeding...")
+        print("VTP mode is transparent or off.\n Proceeding...")
 
         # Import args into matrix.
         # Primary needs to be last because secondary needs to exist before association add.
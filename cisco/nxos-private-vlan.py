@@ -3,7 +3,7 @@
 """
 Author: Stefano Amodei <stefano.amodei@pm.me>
 Date: 2022-10-13
-Usage: python nxos-private-vlan.py hostname -n VLAN -p 100 -c 101 -i 102
+Usage: python nxos-private-vlan.py hostname -n VLAN -p 100 -c 101 -i 102 [-t nxapi]
 Description: Script to automate the process of creating private VLANs and their associations.
 """
 
@@ -15,6 +15,9 @@ import sys
 from netmiko import ConnectHandler
 import numpy
 
+from private_vlan_bulk import (NxapiConnection, build_config_commands, check_vlan_exists, get_capabilities,
+                               get_config_errors, get_vlan_names)
+
 
 # NOTE SVI creation is not included in this script.
 # NOTE Switchport modes for host and promiscuous mode is not included in this script.
@@ -24,66 +27,12 @@ import numpy
 # TODO Create more verbose output to see a response from the switch.
 
 
-def get_vtp_mode(net_connect):
-    # Check if vtp is transparent.
-    vtp = (net_connect.send_command("show vtp status"))
-
-    if "Transparent" in vtp:
-        return True
-    elif "Service not enabled":
-        return True
-    else:
-        return False
-
-
-def get_feature_enabled(net_connect):
-    # Check if private-vlan feature is enabled.
-    feature = (net_connect.send_command("show feature | i private-vlan"))
-
-    if "enabled" in feature:
-        return True
-    else:
-        return False
-
-
-def check_vlan_exists(net_connect, vlan):
-    # Check if VLAN already exists.
-    for row in vlan:
-        vlan_search = (net_connect.send_command("show vlan id " + row[0]))
-
-    if "not found" in vlan_search:
-        return False
-    else:
-        return True
-
-
 def create_vlan(net_connect, vlan, name):
-    # Create VLAN.
-    # I would like to create one config_commands, but not sure how to add the extra line required by primary.
-    for row in vlan:
-        if row[1] == "community":
-            config_commands = [
-                    'vlan ' + row[0],
-                    'name ' + name.upper() + '-C',
-                    'private-vlan community'
-                    ]
-        elif row[1] == "isolated":
-            config_commands = [
-                    'vlan ' + row[0],
-                    'name ' + name.upper() + '-I',
-                    'private-vlan isolated'
-                    ]
-        elif row[1] == "primary":
-            config_commands = [
-                    'vlan ' + row[0],
-                    'name ' + name.upper() + '-P',
-                    'private-vlan primary',
-                    'private-vlan association add ' + vlan[0, 0] + ',' + vlan[1, 0]
-                    ]
-        else:
-            print("Sup :^)")
-            sys.exit()
-        net_connect.send_config_set(config_commands)
+    # Create every VLAN of the row in one config set, which NX-API sends as a single request.
+    # Returns the lines the switch rejected, empty if everything went in.
+    config_commands = [command for block in build_config_commands(vlan, name) for command in block]
+
+    return get_config_errors(net_connect.send_config_set(config_commands))
 
 
 def main():
@@ -94,6 +43,18 @@ def main():
     parser.add_argument("-p", "--primary", type=int, metavar='', required=True, help="Primary VLAN ID")
     parser.add_argument("-c", "--community", type=int, metavar='', required=True, help="Community VLAN ID")
     parser.add_argument("-i", "--isolated", type=int, metavar='', required=True, help="Isolated VLAN ID")
+    parser.add_argument("-t", "--transport", choices=["ssh", "nxapi"], default="ssh",
+            help="Transport to the switch (default ssh).")
+    parser.add_argument("--nxapi-port", type=int, metavar='',
+            help="NX-API port (default 443, or 80 with --nxapi-http).")
+    parser.add_argument("--nxapi-http", action="store_true",
+            help="Use plain HTTP for NX-API, e.g. against a lab or stand-in server.")
+    parser.add_argument("-k", "--insecure", action="store_true",
+            help="Don't verify the NX-API certificate.")
+    parser.add_argument("--cache-ttl", type=int, default=86400, metavar='',
+            help="Seconds to trust cached VTP/feature/version probes, 0 to disable (default 86400).")
+    parser.add_argument("--refresh", action="store_true",
+            help="Ignore the capability cache and probe the switch again.")
     args = parser.parse_args()
 
     # Device info.
@@ -104,14 +65,20 @@ def main():
             'password': getpass.getpass()
             }
 
-    # Initiate the SSH connection.
-    net_connect = ConnectHandler(**cisco_switch)
+    if args.transport == "nxapi":
+        # NX-API gets the checks back as structured output in one request.
+        scheme = "http" if args.nxapi_http else "https"
+        port = args.nxapi_port or (80 if args.nxapi_http else 443)
+        net_connect = NxapiConnection(args.host, cisco_switch['username'], cisco_switch['password'],
+                                      port, scheme, not args.insecure)
+    else:
+        # Initiate the SSH connection.
+        net_connect = ConnectHandler(**cisco_switch)
 
-    # Check if private-vlan feature is enabled.
-    feature_enabled = get_feature_enabled(net_connect)
-    
-    # Check if VTP is transparent or disabled.
-    vtp_status = get_vtp_mode(net_connect)
+    # Check if private-vlan feature is enabled and VTP is transparent or disabled, cached between runs.
+    capabilities = get_capabilities(net_connect, args.host, 'nxos', args.cache_ttl, args.refresh)
+    feature_enabled = capabilities['feature']
+    vtp_status = capabilities['vtp']
 
     # Check if VTP mode is transparent.
     if feature_enabled and vtp_status is True:
@@ -122,11 +89,13 @@ def main():
                             [str(args.isolated), "isolated"],
                             [str(args.primary), "primary"]])
 
-        # Check if any of the provided VLANs currently exist.
-        vlan_exists = check_vlan_exists(net_connect, vlan)
+        # Check if any of the provided VLANs currently exist, against one pull of the VLAN table.
+        vlan_exists = check_vlan_exists(get_vlan_names(net_connect), vlan)
         if vlan_exists is False:
             # Create VLANs.
-            create_vlan(net_connect, vlan, args.name)
+            errors = create_vlan(net_connect, vlan, args.name)
+            for error in errors:
+                print(error)
         elif vlan_exists is True:
             print("One of the provided VLANs is currently in use. Please choose another.")
 
@@ -0,0 +1,182 @@
+#!/bin/python3
+
+"""
+Usage: python private-vlan-allocate.py -i INVENTORY -n NAMES [-o FILE]
+Description: Script to pick private VLAN IDs that are free on every switch of an inventory.
+The output is the VLANNAME,Primary VLAN ID,Isolated VLAN ID,Community VLAN ID file
+consumed by ios-private-vlan-bulk.py and nxos-private-vlan-bulk.py.
+"""
+
+import argparse
+import getpass
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from netmiko import ConnectHandler
+
+from private_vlan_bulk import PLATFORMS, RESERVED_VLANS, get_vlan_names, read_inventory
+
+
+# NOTE VLAN usage is held as 4096-bit bitmaps (plain ints), bit N set means VLAN N is taken.
+
+
+def range_bitmap(low, high):
+    # Bitmap with every VLAN from low to high set.
+    return ((1 << (high - low + 1)) - 1) << low
+
+
+def get_vlan_bitmap(net_connect):
+    # Pull the VLAN table once and set a bit for every VLAN ID currently in use.
+    bitmap = 0
+    for vid in get_vlan_names(net_connect):
+        bitmap |= 1 << vid
+
+    return bitmap
+
+
+def snapshot_switch(switch):
+    # Returns the VLAN bitmap of one switch, or the error that stopped it.
+    try:
+        net_connect = ConnectHandler(**switch)
+        try:
+            return get_vlan_bitmap(net_connect), None
+        finally:
+            net_connect.disconnect()
+    except Exception as e:
+        message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+        return None, message
+
+
+def read_bulk_bitmap(file):
+    # Set a bit for every VLAN ID already planned in an existing bulk file.
+    bitmap = 0
+    for line in file:
+        for field in line.strip().split(',')[1:]:
+            if field.strip().isdigit():
+                bitmap |= 1 << int(field)
+
+    return bitmap
+
+
+def take_lowest(free, count):
+    # Take the count lowest free VLANs, or None if there aren't enough.
+    vids = []
+    while free and len(vids) < count:
+        lowest = free & -free
+        vids.append(lowest.bit_length() - 1)
+        free ^= lowest
+
+    return vids if len(vids) == count else None
+
+
+def allocate(names, free):
+    # Give every name a primary, isolated and community VLAN.
+    # Consecutive triples are preferred; a triple starts wherever bits N, N+1 and N+2 are all free.
+    rows = []
+    for name in names:
+        triples = free & (free >> 1) & (free >> 2)
+        if triples:
+            primary = (triples & -triples).bit_length() - 1
+            vids = [primary, primary + 1, primary + 2]
+        else:
+            vids = take_lowest(free, 3)
+            if vids is None:
+                print("Ran out of free VLANs at " + name + ".")
+                sys.exit(1)
+        for vid in vids:
+            free &= ~(1 << vid)
+        rows.append([name] + vids)
+
+    return rows
+
+
+def check_range(value, platforms):
+    # Return what's wrong with a LOW-HIGH range, or None if it's usable.
+    # Reserved VLANs inside the range are skipped anyway, but not as a bound.
+    bounds = value.split('-')
+    if len(bounds) != 2 or not all(vid.strip().isdigit() for vid in bounds):
+        return "expected LOW-HIGH, got " + value
+    low, high = (int(vid) for vid in bounds)
+    if low < 1 or high > 4094:
+        return "VLAN IDs must be between 1 and 4094"
+    if low > high:
+        return str(low) + " is above " + str(high)
+    for platform in sorted(platforms):
+        for reserved_low, reserved_high in RESERVED_VLANS[platform]:
+            for vid in (low, high):
+                if reserved_low <= vid <= reserved_high:
+                    return "VLAN " + str(vid) + " is reserved on " + platform
+
+    return None
+
+
+def main():
+    # Create the parser and arguments.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--inventory", type=argparse.FileType('r'), required=True,
+            help="File of HOST,PLATFORM lines (ios or nxos) to snapshot.")
+    parser.add_argument("-n", "--names", type=argparse.FileType('r'), required=True,
+            help="File with one private VLAN name per line.")
+    parser.add_argument("-o", "--output", type=argparse.FileType('w'), default=sys.stdout,
+            help="Bulk file to write (default stdout).")
+    parser.add_argument("-r", "--range", metavar='',
+            help="VLAN IDs to allocate from as LOW-HIGH (default 2-4094, reserved VLANs are always skipped).")
+    parser.add_argument("-x", "--exclude", type=argparse.FileType('r'), action="append", default=[],
+            help="Existing bulk file whose VLAN IDs must not be reused. Can be repeated.")
+    parser.add_argument("-w", "--workers", type=int, default=20, metavar='',
+            help="Maximum switches snapshotted at once (default 20).")
+    args = parser.parse_args()
+
+    inventory = read_inventory(args.inventory, 'ios')
+    low, high = 2, 4094
+    if args.range is not None:
+        error = check_range(args.range, set(platform for _, platform in inventory))
+        if error is not None:
+            parser.error("-r/--range: " + error)
+        low, high = (int(vid) for vid in args.range.split('-'))
+    names = [line.strip() for line in args.names if line.strip()]
+
+    # Credentials are shared by every switch, so only prompt once.
+    username = getpass.getuser()
+    password = getpass.getpass()
+
+    # Device info.
+    switches = []
+    for host, platform in inventory:
+        cisco_switch = {
+                'device_type':  PLATFORMS[platform],
+                'host': host,
+                'username': username,
+                'password': password
+                }
+        switches.append(cisco_switch)
+
+    # Snapshot every switch through a bounded worker pool.
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        snapshots = list(pool.map(snapshot_switch, switches))
+
+    # A VLAN is only free if no switch uses it.
+    used = 0
+    for (host, _), (bitmap, error) in zip(inventory, snapshots):
+        if error is not None:
+            print(host + ": " + error, file=sys.stderr)
+            print("Can't allocate without a snapshot of every switch.", file=sys.stderr)
+            sys.exit(1)
+        used |= bitmap
+
+    for platform in set(platform for _, platform in inventory):
+        for reserved_low, reserved_high in RESERVED_VLANS[platform]:
+            used |= range_bitmap(reserved_low, reserved_high)
+    for file in args.exclude:
+        used |= read_bulk_bitmap(file)
+
+    free = range_bitmap(low, high) & ~used
+    print(str(len(switches)) + " switches, " + str(bin(free).count("1")) + " VLANs free on all of them.", file=sys.stderr)
+
+    for row in allocate(names, free):
+        args.output.write(",".join(str(field) for field in row) + "\n")
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
@@ -0,0 +1,998 @@
+#!/bin/python3
+
+"""
+Usage: python private_vlan_bulk.py --platform ios|nxos hostname -f FILE
+       python private_vlan_bulk.py -i INVENTORY -f FILE
+Description: Shared code of ios-private-vlan-bulk.py and nxos-private-vlan-bulk.py.
+Those two only pick the platform of the host argument; everything else lives here.
+"""
+
+import argparse
+import base64
+import datetime
+import getpass
+import hashlib
+import json
+import os
+import re
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from netmiko import ConnectHandler, file_transfer
+import numpy
+
+
+# NOTE SVI creation is not included in this script.
+# NOTE Switchport modes for host and promiscuous mode is not included in this script.
+# NOTE I would've liked to make this more flexible, but I'm creating it for my needs right now.
+
+# TODO Create more verbose output to see a response from the switch.
+
+# Netmiko device type per inventory platform.
+PLATFORMS = {
+        'ios':  'cisco_ios',
+        'nxos': 'cisco_nxos_ssh',
+        }
+
+# File system the config file is copied to in file delivery mode, per platform.
+FILE_SYSTEMS = {
+        'ios':  'flash:',
+        'nxos': 'bootflash:',
+        }
+
+# VLAN ID ranges that can't be used for private VLANs, per platform.
+# 1 is the default VLAN, 1002-1005 are the IOS legacy defaults and 3968-4094 are NX-OS internal VLANs.
+RESERVED_VLANS = {
+        'ios':  [(1, 1), (1002, 1005)],
+        'nxos': [(1, 1), (3968, 4094)],
+        }
+
+# Journal writes can come from several sessions of the same switch at once.
+JOURNAL_LOCK = threading.Lock()
+
+# Per-host cache of the VTP, private-vlan feature and version probes.
+CAPABILITY_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "network-scripts", "capabilities.json")
+
+# Cache writes can come from several switches at once.
+CACHE_LOCK = threading.Lock()
+
+
+class NxapiConnection:
+    # Minimal NX-API client (JSON-RPC over HTTPS) covering the parts of the netmiko interface these scripts use.
+    # Every call is a single HTTP request no matter how many commands it carries.
+
+    def __init__(self, host, username, password, port=443, scheme="https", verify=True, timeout=60):
+        self.host = host
+        self.url = scheme + "://" + host + ":" + str(port) + "/ins"
+        credentials = base64.b64encode((username + ":" + password).encode()).decode()
+        self.headers = {
+                'Content-Type': 'application/json-rpc',
+                'Authorization': 'Basic ' + credentials,
+                }
+        self.context = None
+        if scheme == "https" and not verify:
+            # Nexus switches ship with a self-signed certificate.
+            self.context = ssl.create_default_context()
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+        self.timeout = timeout
+
+    def request(self, commands, method):
+        # Send every command in one JSON-RPC batch and return the replies in command order.
+        payload = []
+        for count, command in enumerate(commands, 1):
+            payload.append({'jsonrpc': '2.0', 'method': method, 'params': {'cmd': command, 'version': 1}, 'id': count})
+        request = urllib.request.Request(self.url, data=json.dumps(payload).encode(), headers=self.headers)
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout, context=self.context) as response:
+                replies = json.load(response)
+        except urllib.error.HTTPError as e:
+            # A failed command comes back as an HTTP error with the JSON-RPC replies in the body.
+            if e.code in (401, 403):
+                raise
+            replies = json.load(e)
+
+        if isinstance(replies, dict):
+            replies = [replies]
+        return sorted(replies, key=lambda reply: reply.get('id', 0))
+
+    def send_command(self, command, **kwargs):
+        # Plain text output, same as over SSH, so the text parsers keep working.
+        reply = self.request([command], "cli_ascii")[0]
+        if 'error' in reply:
+            return "% " + get_nxapi_error(reply)
+        return reply['result']['msg'] if reply.get('result') else ""
+
+    def send_commands(self, commands):
+        # Structured output for several show commands in one request.
+        # A command that fails returns None instead of a body.
+        bodies = []
+        for reply in self.request(commands, "cli"):
+            if 'error' in reply or not reply.get('result'):
+                bodies.append(None)
+            else:
+                bodies.append(reply['result']['body'])
+        return bodies
+
+    def send_config_set(self, config_commands, **kwargs):
+        # NX-API runs the batch in order in one config context, no configure terminal needed.
+        # Failed commands are reported as ERROR: lines like the CLI does.
+        output = []
+        for command, reply in zip(config_commands, self.request(config_commands, "cli")):
+            output.append(command)
+            if 'error' in reply:
+                output.append("ERROR: " + get_nxapi_error(reply))
+        return "\n".join(output)
+
+    def disconnect(self):
+        # Nothing to tear down, every request authenticates on its own.
+        pass
+
+
+def get_nxapi_error(reply):
+    # NX-API puts the CLI error text in data.msg and a generic message next to it.
+    error = reply['error']
+    if isinstance(error.get('data'), dict) and error['data'].get('msg'):
+        return error['data']['msg'].strip()
+    return error.get('message', "Unknown error")
+
+
+def get_nxapi_rows(body, table):
+    # NX-API wraps tables as TABLE_x/ROW_x, and ROW_x is a dict instead of a list when there is one row.
+    if not body or 'TABLE_' + table not in body:
+        return []
+    rows = body['TABLE_' + table]['ROW_' + table]
+    if isinstance(rows, dict):
+        rows = [rows]
+    return rows
+
+
+def get_nxapi_checks(nxapi):
+    # Feature, VTP and version checks in one NX-API request with structured output.
+    feature, vtp, version = nxapi.send_commands(["show feature", "show vtp status", "show version"])
+
+    feature_enabled = False
+    for row in get_nxapi_rows(feature, 'cfcFeatureCtrlTable'):
+        if row.get('cfcFeatureCtrlName2') == "private-vlan" and row.get('cfcFeatureCtrlOpStatus2') == "enabled":
+            feature_enabled = True
+
+    # show vtp status fails when feature vtp is off, which is as good as transparent, same as get_vtp_mode.
+    vtp_status = True
+    if vtp is not None:
+        vtp_status = str(vtp.get('oper_mode', "")).strip().lower() in ("transparent", "off")
+
+    version = version or {}
+    version = version.get('nxos_ver_str') or version.get('sys_ver_str') or version.get('kickstart_ver_str') or "unknown"
+
+    return feature_enabled, vtp_status, version
+
+
+def load_capabilities():
+    # Read the capability cache, an empty one if it's missing or unreadable.
+    try:
+        with open(CAPABILITY_CACHE, 'r') as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_capabilities(host, capabilities):
+    # Store (or with None, invalidate) one host in the capability cache.
+    # The file is re-read first so runs in parallel don't drop each other's hosts.
+    with CACHE_LOCK:
+        cache = load_capabilities()
+        if capabilities is None:
+            cache.pop(host, None)
+        else:
+            cache[host] = capabilities
+        os.makedirs(os.path.dirname(CAPABILITY_CACHE), exist_ok=True)
+        temp = CAPABILITY_CACHE + "." + str(os.getpid()) + ".tmp"
+        with open(temp, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(temp, CAPABILITY_CACHE)
+
+
+def get_version(net_connect, platform):
+    # Software version of show version, e.g. 15.2(4)E10 on IOS or 9.3(8) on NX-OS.
+    # NX-OS lists the BIOS and the GPL license versions first, so only its NXOS: or system: line counts.
+    version = (net_connect.send_command("show version"))
+    if platform == "nxos":
+        match = re.search(r"(?:NXOS|system):\s+version\s+([0-9][\w.()]*)", version)
+    else:
+        match = re.search(r"[Vv]ersion:?\s+([0-9][\w.()]*)", version)
+
+    return match.group(1) if match else "unknown"
+
+
+def probe_capabilities(net_connect, platform):
+    # Probe the switch for everything the capability cache holds.
+    if isinstance(net_connect, NxapiConnection):
+        feature_enabled, vtp_status, version = get_nxapi_checks(net_connect)
+    else:
+        feature_enabled = get_feature_enabled(net_connect) if platform == "nxos" else None
+        vtp_status = get_vtp_mode(net_connect)
+        version = get_version(net_connect, platform)
+    return {
+            'platform': platform,
+            'vtp': vtp_status,
+            'feature': feature_enabled,
+            'version': version,
+            'time': time.time(),
+            }
+
+
+def get_capabilities(net_connect, host, platform, ttl, refresh=False):
+    # Cached capabilities of the switch, probed when missing, older than ttl or refresh is set.
+    # Only switches that pass both checks are cached so a fix on the switch is seen on the next run.
+    if not refresh and ttl > 0:
+        cached = load_capabilities().get(host)
+        if cached and cached.get('platform') == platform and time.time() - cached.get('time', 0) < ttl:
+            return cached
+
+    capabilities = probe_capabilities(net_connect, platform)
+    if ttl > 0 and capabilities['vtp'] and capabilities['feature'] is not False:
+        save_capabilities(host, capabilities)
+
+    return capabilities
+
+
+def get_vtp_mode(net_connect):
+    # Check if VTP is transparent, off or not running, the modes that allow private VLANs.
+    # VTPv3 lists a mode per feature, the first Operating Mode line is the VLAN one either way.
+    # NX-OS rejects the command outright while feature vtp is off, which is as good as transparent.
+    vtp = (net_connect.send_command("show vtp status"))
+
+    if "not enabled" in vtp or "Invalid command" in vtp:
+        return True
+    for line in vtp.splitlines():
+        if "Operating Mode" in line and ":" in line:
+            mode = line.split(":", 1)[1].strip().lower()
+            return mode in ("transparent", "off")
+
+    return False
+
+
+def get_feature_enabled(net_connect):
+    # Check if private-vlan feature is enabled.
+    feature = (net_connect.send_command("show feature | i private-vlan"))
+
+    if "enabled" in feature:
+        return True
+    else:
+        return False
+
+
+def get_vlan_names(net_connect):
+    # Pull the VLAN table once and map every VLAN ID currently in use to its name.
+    # Continuation lines (wrapped port lists) and headers don't start with a digit.
+    vlan_names = {}
+    if isinstance(net_connect, NxapiConnection):
+        body = net_connect.send_commands(["show vlan brief"])[0]
+        for row in get_nxapi_rows(body, 'vlanbriefxbrief'):
+            vlan_names[int(row['vlanshowbr-vlanid'])] = row.get('vlanshowbr-vlanname', "")
+        return vlan_names
+
+    vlan_brief = (net_connect.send_command("show vlan brief"))
+    for line in vlan_brief.splitlines():
+        fields = line.split()
+        if fields and fields[0].isdigit():
+            vlan_names[int(fields[0])] = fields[1] if len(fields) > 1 else ""
+
+    return vlan_names
+
+
+def get_pvlan_state(net_connect):
+    # Pull the private VLAN table once.
+    # Returns the type of every private VLAN and the secondaries associated with each primary.
+    pvlan = (net_connect.send_command("show vlan private-vlan"))
+
+    types = {}
+    associations = {}
+    for line in pvlan.splitlines():
+        fields = line.split()
+        if not fields or not fields[0].isdigit():
+            continue
+        if line[0].isdigit():
+            # Primary Secondary Type Ports, secondary is "none" when nothing is associated.
+            primary = int(fields[0])
+            types[primary] = "primary"
+            associations.setdefault(primary, set())
+            if len(fields) > 2 and fields[1].isdigit():
+                types[int(fields[1])] = fields[2]
+                associations[primary].add(int(fields[1]))
+        elif len(fields) > 1:
+            # Secondary that isn't associated to a primary yet.
+            types[int(fields[0])] = fields[1]
+
+    return types, associations
+
+
+def check_vlan_exists(vlan_index, vlan):
+    # Check if any VLAN of the row already exists in the index.
+    for row in vlan:
+        if int(row[0]) in vlan_index:
+            return True
+
+    return False
+
+
+def build_config_commands(vlan, name):
+    # Build one block of config commands per VLAN in the row.
+    # I would like to create one config_commands, but not sure how to add the extra line required by primary.
+    blocks = []
+    for row in vlan:
+        if row[1] == "community":
+            config_commands = [
+                    'vlan ' + row[0],
+                    'name ' + name.upper() + '-C',
+                    'private-vlan community'
+                    ]
+        elif row[1] == "isolated":
+            config_commands = [
+                    'vlan ' + row[0],
+                    'name ' + name.upper() + '-I',
+                    'private-vlan isolated'
+                    ]
+        elif row[1] == "primary":
+            config_commands = [
+                    'vlan ' + row[0],
+                    'name ' + name.upper() + '-P',
+                    'private-vlan primary',
+                    'private-vlan association add ' + vlan[0, 0] + ',' + vlan[1, 0]
+                    ]
+        else:
+            print("Sup :^)")
+            sys.exit()
+        blocks.append(config_commands)
+
+    return blocks
+
+
+def diff_config_commands(vlan, name, vlan_names, types, associations):
+    # Trim each VLAN block down to the commands the switch is missing.
+    # A block is None when that VLAN already matches the bulk file.
+    blocks = []
+    for row, config_commands in zip(vlan, build_config_commands(vlan, name)):
+        vid = int(row[0])
+        missing = []
+        if vlan_names.get(vid) != config_commands[1][len('name '):]:
+            missing.append(config_commands[1])
+        if types.get(vid) != row[1]:
+            missing.append(config_commands[2])
+        if row[1] == "primary":
+            secondaries = {int(vlan[0, 0]), int(vlan[1, 0])}
+            if not secondaries <= associations.get(vid, set()):
+                missing.append(config_commands[3])
+
+        if missing:
+            blocks.append([config_commands[0]] + missing)
+        else:
+            blocks.append(None)
+
+    return blocks
+
+
+def create_vlan(net_connect, blocks):
+    # Create VLAN, one config set per VLAN block.
+    # Returns the lines the switch rejected, empty if every block went in.
+    errors = []
+    for config_commands in blocks:
+        if config_commands is not None:
+            errors += get_config_errors(net_connect.send_config_set(config_commands))
+
+    return errors
+
+
+def chunk_blocks(blocks, chunk_size):
+    # Pack VLAN blocks into config sets of roughly chunk_size commands.
+    # A VLAN block is never split, otherwise its commands would land outside the vlan context.
+    chunks = []
+    chunk = []
+    for config_commands in blocks:
+        if chunk and len(chunk) + len(config_commands) > chunk_size:
+            chunks.append(chunk)
+            chunk = []
+        chunk += config_commands
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def compile_config_chunks(rows, chunk_size):
+    # Compile every row into two phases of config sets.
+    # All secondaries go out before any primary so every association add resolves.
+    # Rows are (vlan, blocks) with blocks lined up on the VLANs, None for nothing to push.
+    secondaries = []
+    primaries = []
+    for vlan, blocks in rows:
+        for row, config_commands in zip(vlan, blocks):
+            if config_commands is None:
+                continue
+            if row[1] == "primary":
+                primaries.append(config_commands)
+            else:
+                secondaries.append(config_commands)
+
+    return [chunk_blocks(secondaries, chunk_size), chunk_blocks(primaries, chunk_size)]
+
+
+def get_config_errors(output):
+    # IOS and NX-OS flag rejected commands with a leading % or an ERROR: line.
+    errors = []
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith("%") or line.startswith("ERROR"):
+            errors.append(line)
+
+    return errors
+
+
+def send_chunk(net_connect, chunk, count, read_timeout=120):
+    # Write a whole chunk at once and read until the config prompt that follows a marker comment sent last.
+    # The switch runs lines in order, so by then every command of the chunk has answered and nothing
+    # of the next chunk has been sent yet. A timing based read would stop at the first quiet gap instead.
+    if isinstance(net_connect, NxapiConnection):
+        # One HTTP request per chunk, the reply is complete already.
+        return net_connect.send_config_set(chunk)
+
+    if not net_connect.check_config_mode():
+        net_connect.config_mode()
+    marker = "! pvlan chunk " + str(count)
+    net_connect.write_channel("".join(command + net_connect.RETURN for command in chunk + [marker]))
+    return net_connect.read_until_pattern(pattern=re.escape(marker) + r".*" + re.escape(net_connect.base_prompt) + r"\(config[^\n]*\)#",
+                                          read_timeout=read_timeout, re_flags=re.S)
+
+
+def get_row_keys(batch):
+    # Map every VLAN ID of the batch to the key of its row, so chunk results can be tied back to rows.
+    return dict((row[0], vlan[2, 0]) for vlan, _ in batch for row in vlan)
+
+
+def push_config_chunks(net_connect, chunks, keys, label="", journal=None, held=()):
+    # Push each chunk in a single config mode session and report per chunk.
+    # Lines aren't echo checked one by one, the chunk is read back to the prompt in one go.
+    # With a journal, the rows of every clean chunk are recorded as done, except those in held.
+    # Returns the keys of the rows with a VLAN in a failed chunk.
+    failed = set()
+    for count, chunk in enumerate(chunks, 1):
+        output = send_chunk(net_connect, chunk, count)
+        errors = get_config_errors(output)
+        rows = [keys[command.split()[1]] for command in chunk if command.startswith("vlan ")]
+        if errors:
+            failed.update(rows)
+            print(label + "Chunk " + str(count) + "/" + str(len(chunks)) + " (" + str(len(chunk)) + " commands): FAILED")
+            for error in errors:
+                print(label + "    " + error)
+        else:
+            print(label + "Chunk " + str(count) + "/" + str(len(chunks)) + " (" + str(len(chunk)) + " commands): OK")
+            if journal is not None:
+                write_journal(journal, "D", sorted(set(rows) - held))
+    if chunks and not isinstance(net_connect, NxapiConnection):
+        net_connect.exit_config_mode()
+
+    return failed
+
+
+def push_config_phases(connections, phases, keys, label="", journal=None):
+    # Spread the chunks of each phase over every session of the switch.
+    # A phase has to finish before the next starts (secondaries before primaries).
+    # Rows only count as done once their primary is in, so the journal follows the last phase,
+    # and a row whose secondaries failed in an earlier phase isn't done whatever its primary did.
+    # Returns the keys of the rows with a VLAN in a failed chunk.
+    failed = set()
+    with ThreadPoolExecutor(max_workers=len(connections)) as pool:
+        for phase, chunks in enumerate(phases):
+            slices = [chunks[i::len(connections)] for i in range(len(connections))]
+            labels = [label + "[" + str(i + 1) + "] " for i in range(len(connections))]
+            journals = [journal if phase == len(phases) - 1 else None] * len(connections)
+            helds = [frozenset(failed)] * len(connections)
+            for result in pool.map(push_config_chunks, connections, slices, [keys] * len(connections), labels, journals, helds):
+                failed |= result
+
+    return failed
+
+
+def deliver_config_file(net_connect, platform, batch, rows, plan_id, args, label=""):
+    # Render the whole change locally, copy it to the switch once and merge it into running-config.
+    # Returns the number of rows that still don't match the bulk file afterwards.
+    if isinstance(net_connect, NxapiConnection):
+        raise ValueError("File delivery needs the SSH transport.")
+
+    phases = compile_config_chunks(batch, args.chunk_size)
+    config = [command for chunks in phases for chunk in chunks for command in chunk] + ["end"]
+    file_system = args.file_system or FILE_SYSTEMS[platform]
+    filename = "pvlan-" + plan_id[:12] + ".cfg"
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            source_file = os.path.join(directory, filename)
+            with open(source_file, 'w') as f:
+                f.write("\n".join(config) + "\n")
+            print(label + "Copying " + str(len(config)) + " lines to " + file_system + filename + "...")
+            transfer = file_transfer(net_connect, source_file=source_file, dest_file=filename,
+                                     file_system=file_system, direction="put", overwrite_file=True)
+        if not transfer['file_verified']:
+            raise ValueError("Could not verify " + file_system + filename + " after the transfer.")
+
+        # IOS asks for the destination filename, NX-OS just copies.
+        output = net_connect.send_command("copy " + file_system + filename + " running-config",
+                                          expect_string=r"Destination filename|#", read_timeout=600)
+        if "Destination filename" in output:
+            output += net_connect.send_command("\n", expect_string=r"#", read_timeout=600)
+        for error in get_config_errors(output):
+            print(label + "    " + error)
+    finally:
+        # Don't leave the staged file behind, or every run adds one more to flash.
+        # A transfer that died half way may have left part of it, so this runs on errors too.
+        delete_file(net_connect, platform, file_system + filename, label)
+
+    # One read of the VLAN and private VLAN tables to confirm every row landed.
+    vlan_names = get_vlan_names(net_connect)
+    types, associations = get_pvlan_state(net_connect)
+    keys = set(vlan[2, 0] for vlan, _ in batch)
+    failed = 0
+    for vlan, vlan_name in rows:
+        if vlan[2, 0] not in keys:
+            continue
+        blocks = diff_config_commands(vlan, vlan_name, vlan_names, types, associations)
+        if any(config_commands is not None for config_commands in blocks):
+            print(label + vlan_name + ": Not in the running-config after the merge.")
+            failed += 1
+
+    return failed
+
+
+def delete_file(net_connect, platform, path, label=""):
+    # Delete a file from the switch without the confirmation prompts.
+    # A failure is only reported, the merge result matters more than the cleanup.
+    if platform == "nxos":
+        command = "delete " + path + " no-prompt"
+    else:
+        command = "delete /force " + path
+    try:
+        output = net_connect.send_command(command, expect_string=r"#", read_timeout=60)
+    except Exception as e:
+        output = "% " + (str(e).strip().splitlines() or [type(e).__name__])[0]
+    for error in get_config_errors(output):
+        print(label + "Could not delete " + path + ": " + error)
+
+
+def get_plan_id(table):
+    # Fingerprint of the bulk file so a journal is never resumed against a different one.
+    return hashlib.sha1("\n".join(",".join(row) for row in table).encode()).hexdigest()
+
+
+def read_journal(path, plan_id):
+    # Journal lines are "S <primary>" when a row is started, "D <primary>" when it's done
+    # and "F <primary>" when the switch rejected part of it.
+    # Returns the rows that are done and the rows that were in flight or failed, which are both re-applied.
+    done = set()
+    started = set()
+    if not os.path.exists(path):
+        return done, started
+
+    with open(path, 'r') as journal:
+        lines = journal.read().split("\n")
+
+    if lines[0] != "# plan " + plan_id:
+        raise ValueError("Journal " + path + " belongs to a different bulk file.")
+
+    # The last line has no newline if the run died mid-write, so it's ignored.
+    for line in lines[1:-1]:
+        record = line.split()
+        if len(record) != 2:
+            continue
+        if record[0] == "S":
+            started.add(record[1])
+        elif record[0] == "D":
+            done.add(record[1])
+
+    return done, started - done
+
+
+def open_journal(path, plan_id, resume):
+    # A fresh run truncates the journal; a resumed run appends to it.
+    if resume and os.path.exists(path):
+        return open(path, 'a')
+
+    journal = open(path, 'w')
+    journal.write("# plan " + plan_id + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+    return journal
+
+
+def write_journal(journal, record, keys):
+    # Append the records and fsync so they survive a dropped session or a crash.
+    if not keys:
+        return
+    with JOURNAL_LOCK:
+        journal.write("".join(record + " " + key + "\n" for key in keys))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def check_platform(capabilities):
+    # Return why the switch can't take private VLANs, or None if it can.
+    if capabilities['feature'] is False:
+        return "Feature private-vlan is disabled."
+    if capabilities['vtp'] is False:
+        return "VTP mode does not support private VLANs."
+
+    return None
+
+
+def load_plan(file):
+    # Load the whole bulk file into columns in one pass.
+    # Wordlist should be formatted as the following:
+    # VLANNAME,Primary VLAN ID, Isolated VLAN ID, Community VLAN ID.
+    # Lines with the wrong number of fields are left out and returned as errors.
+    lines = []
+    numbers = []
+    errors = []
+    for number, line in enumerate(file, 1):
+        # Strip new line character from line.
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        # Split line on comma and store in list.
+        line = line.split(',')
+        if len(line) != 4:
+            errors.append("Line " + str(number) + ": expected 4 fields, got " + str(len(line)) + ".")
+            continue
+        lines.append(line)
+        numbers.append(number)
+
+    table = numpy.char.strip(numpy.array(lines, dtype=str).reshape(-1, 4))
+    return numpy.array(numbers, dtype=int), table, errors
+
+
+def validate_plan(numbers, table, platforms):
+    # Check every row at once before any switch is touched.
+    # Returns a list of errors, empty if the plan is good.
+    errors = []
+    names = table[:, 0]
+    for number in numbers[names == ""]:
+        errors.append("Line " + str(number) + ": missing VLAN name.")
+
+    numeric = numpy.char.isdigit(table[:, 1:4]).all(axis=1)
+    for number in numbers[~numeric]:
+        errors.append("Line " + str(number) + ": VLAN IDs must be numbers.")
+
+    # Columns are primary, isolated, community.
+    numbers = numbers[numeric]
+    ids = table[numeric, 1:4].astype(int).reshape(-1, 3)
+
+    bad = ((ids < 1) | (ids > 4094)).any(axis=1)
+    for number in numbers[bad]:
+        errors.append("Line " + str(number) + ": VLAN IDs must be between 1 and 4094.")
+
+    for platform in sorted(platforms):
+        reserved = numpy.zeros(ids.shape, dtype=bool)
+        for low, high in RESERVED_VLANS[platform]:
+            reserved |= (ids >= low) & (ids <= high)
+        for number in numbers[reserved.any(axis=1)]:
+            errors.append("Line " + str(number) + ": VLAN ID reserved on " + platform + ".")
+
+    overlap = (ids[:, 0] == ids[:, 1]) | (ids[:, 0] == ids[:, 2]) | (ids[:, 1] == ids[:, 2])
+    for number in numbers[overlap]:
+        errors.append("Line " + str(number) + ": primary, isolated and community VLAN IDs must differ.")
+
+    # Count how many distinct rows use each ID; anything above one is reused across rows.
+    rows = numpy.repeat(numpy.arange(len(ids)), 3)
+    pairs = numpy.unique(numpy.stack([ids.ravel(), rows]), axis=1)
+    vids, counts = numpy.unique(pairs[0], return_counts=True)
+    duplicates = vids[counts > 1]
+    for vid in duplicates:
+        used = numbers[numpy.isin(ids, vid).any(axis=1)]
+        errors.append("VLAN " + str(vid) + " is used on lines " + ", ".join(str(number) for number in used) + ".")
+
+    return errors
+
+
+def plan_rows(table):
+    # Turn the plan into the (vlan, name) rows used by the creation logic.
+    # Primary needs to be last because secondary needs to exist before association add.
+    vids = table[:, 3:0:-1]
+    roles = numpy.broadcast_to(numpy.array(["community", "isolated", "primary"]), vids.shape)
+    vlans = numpy.stack([vids, roles], axis=2)
+
+    return list(zip(vlans, table[:, 0]))
+
+
+def print_plan(rows, chunk_size):
+    # Print the commands that would be pushed to a switch with none of the VLANs.
+    phases = compile_config_chunks([(vlan, build_config_commands(vlan, name)) for vlan, name in rows], chunk_size)
+    count = 0
+    for phase, chunks in zip(["secondary", "primary"], phases):
+        for chunk in chunks:
+            count += 1
+            print("! Config set " + str(count) + " (" + phase + ", " + str(len(chunk)) + " commands)")
+            for command in chunk:
+                print(command)
+
+
+def read_inventory(file, default_platform):
+    # Inventory should be formatted as HOST,PLATFORM with PLATFORM ios or nxos.
+    # Blank lines and lines starting with # are ignored.
+    inventory = []
+    for line in file:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        line = line.split(',')
+
+        host = line[0].strip()
+        platform = line[1].strip().lower() if len(line) > 1 else default_platform
+        if platform is None:
+            print("No platform for " + host + ", add one to the inventory or give --platform.")
+            sys.exit(1)
+        if platform not in PLATFORMS:
+            print("Unknown platform " + platform + " for " + host + ".")
+            sys.exit(1)
+        inventory.append((host, platform))
+
+    return inventory
+
+
+def connect_switch(switch, platform, args):
+    # NX-OS switches can go over NX-API instead of SSH.
+    if platform == "nxos" and args.transport == "nxapi":
+        scheme = "http" if args.nxapi_http else "https"
+        port = args.nxapi_port or (80 if args.nxapi_http else 443)
+        return NxapiConnection(switch['host'], switch['username'], switch['password'],
+                               port, scheme, not args.insecure)
+
+    return ConnectHandler(**switch)
+
+
+def deploy_switch(switch, platform, rows, plan_id, args):
+    # Run the checks and the creation logic against one switch.
+    host = switch['host']
+    label = host + ": "
+    result = {'host': host, 'platform': platform, 'status': "OK", 'applied': 0, 'skipped': 0, 'in_sync': 0, 'resumed': 0, 'failed': 0, 'version': ""}
+    start = time.monotonic()
+    connections = []
+    journal = None
+
+    try:
+        # Rows finished by a previous run are skipped, the one in flight is re-applied.
+        journal_path = os.path.join(args.journal_dir, "pvlan-" + host + ".journal")
+        done, in_flight = set(), set()
+        if args.resume:
+            done, in_flight = read_journal(journal_path, plan_id)
+        journal = open_journal(journal_path, plan_id, args.resume)
+
+        # Initiate the SSH connection.
+        net_connect = connect_switch(switch, platform, args)
+        connections.append(net_connect)
+
+        # Check if feature private-vlan is enabled and VTP mode is transparent or disabled.
+        capabilities = get_capabilities(net_connect, host, platform, args.cache_ttl, args.refresh)
+        result['version'] = capabilities['version']
+        status = check_platform(capabilities)
+        if status is not None:
+            print(label + status)
+            result['status'] = status
+            return result
+
+        # Snapshot the VLANs in use once instead of probing every ID.
+        # Converging also needs the private VLAN table to diff against.
+        vlan_names = get_vlan_names(net_connect)
+        vlan_index = set(vlan_names)
+        if args.converge:
+            types, associations = get_pvlan_state(net_connect)
+
+        # Rows to push in batch mode.
+        batch = []
+
+        for vlan, vlan_name in rows:
+            # Rows are keyed on their primary VLAN ID, which validation keeps unique.
+            key = vlan[2, 0]
+            if key in done:
+                result['resumed'] += 1
+                continue
+
+            if args.converge:
+                # Only push what the switch is missing; existing VLANs are brought in line.
+                blocks = diff_config_commands(vlan, vlan_name, vlan_names, types, associations)
+                if all(config_commands is None for config_commands in blocks):
+                    result['in_sync'] += 1
+                    continue
+                vlan_exists = False
+            else:
+                # Check if any of the provided VLANs currently exist.
+                # A row that was in flight may be half there; re-applying it is harmless.
+                blocks = build_config_commands(vlan, vlan_name)
+                vlan_exists = check_vlan_exists(vlan_index, vlan)
+                if key in in_flight:
+                    print(label + vlan_name + ": Row was in flight or failed in the last run. Re-applying.")
+                    vlan_exists = False
+            if vlan_exists is False:
+                # Create VLANs and record them so later rows can't reuse the IDs.
+                if args.batch or args.delivery == "file":
+                    batch.append((vlan, blocks))
+                else:
+                    write_journal(journal, "S", [key])
+                    errors = create_vlan(net_connect, blocks)
+                    if errors:
+                        # Some of the row may be on the switch, so its IDs stay taken below.
+                        write_journal(journal, "F", [key])
+                        print(label + vlan_name + ": FAILED")
+                        for error in errors:
+                            print(label + "    " + error)
+                        vlan_index.update(int(row[0]) for row in vlan)
+                        result['failed'] += 1
+                        continue
+                    write_journal(journal, "D", [key])
+                vlan_index.update(int(row[0]) for row in vlan)
+                result['applied'] += 1
+            elif vlan_exists is True:
+                print(label + vlan_name + ": One of the provided VLANs is currently in use. Please choose another.")
+                result['skipped'] += 1
+
+        if result['failed']:
+            result['status'] = "Config errors"
+            save_capabilities(host, None)
+
+        if batch and args.delivery == "file":
+            write_journal(journal, "S", [vlan[2, 0] for vlan, _ in batch])
+            result['failed'] = deliver_config_file(net_connect, platform, batch, rows, plan_id, args, label)
+            result['applied'] -= result['failed']
+            if result['failed']:
+                result['status'] = "Merge incomplete"
+                save_capabilities(host, None)
+            else:
+                write_journal(journal, "D", [vlan[2, 0] for vlan, _ in batch])
+        elif batch:
+            phases = compile_config_chunks(batch, args.chunk_size)
+            # Extra sessions only pay off when there's more than one chunk per phase.
+            for _ in range(min(args.sessions, max(len(chunks) for chunks in phases)) - 1):
+                connections.append(connect_switch(switch, platform, args))
+            print(label + "Pushing " + str(len(batch)) + " rows in " + str(sum(len(chunks) for chunks in phases))
+                  + " config sets over " + str(len(connections)) + " sessions...")
+            write_journal(journal, "S", [vlan[2, 0] for vlan, _ in batch])
+            failed = push_config_phases(connections, phases, get_row_keys(batch), label, journal)
+            write_journal(journal, "F", sorted(failed))
+            result['failed'] = len(failed)
+            result['applied'] -= result['failed']
+            if result['failed']:
+                result['status'] = "Config errors"
+                # The cached checks may be what let a misconfigured switch through.
+                save_capabilities(host, None)
+            else:
+                # Rows with nothing to change on their primary aren't caught by the per-chunk records.
+                write_journal(journal, "D", [vlan[2, 0] for vlan, _ in batch])
+    except Exception as e:
+        # One unreachable or misbehaving switch shouldn't stop the rest of the fleet.
+        message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+        print(label + message)
+        result['status'] = "Error: " + message
+    finally:
+        # Disconnect the SSH connections.
+        for connection in connections:
+            connection.disconnect()
+        if journal is not None:
+            journal.close()
+        result['time'] = time.monotonic() - start
+
+    return result
+
+
+def print_results(results):
+    # Consolidated per-host results table.
+    print()
+    print("{:<24} {:<9} {:<12} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}  {}".format(
+        "HOST", "PLATFORM", "VERSION", "APPLIED", "SKIPPED", "IN SYNC", "RESUMED", "FAILED", "TIME", "STATUS"))
+    for result in results:
+        print("{:<24} {:<9} {:<12} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7.1f}s  {}".format(
+            result['host'], result['platform'], result['version'], result['applied'], result['skipped'], result['in_sync'],
+            result['resumed'], result['failed'], result['time'], result['status']))
+
+
+def main(platform=None):
+    # Create the parser and arguments.
+    # platform is the default of the per-platform entry points, --platform overrides it.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", nargs='?', help="IP address or hostname of the Cisco switch")
+    parser.add_argument("--platform", choices=sorted(PLATFORMS), default=platform,
+            help="Platform of the host argument and of inventory lines without one"
+                 + (" (default " + platform + ")." if platform else "."))
+    parser.add_argument("-f", "--file", type=argparse.FileType('r'), required=True)
+    parser.add_argument("-i", "--inventory", type=argparse.FileType('r'),
+            help="File of HOST,PLATFORM lines (ios or nxos) to deploy to instead of a single host.")
+    parser.add_argument("-b", "--batch", action="store_true",
+            help="Compile all rows and push them in as few config sets as possible.")
+    parser.add_argument("--chunk-size", type=int, default=500, metavar='',
+            help="Maximum commands per config set in batch mode (default 500).")
+    parser.add_argument("-w", "--workers", type=int, default=10, metavar='',
+            help="Maximum switches configured at once (default 10).")
+    parser.add_argument("-n", "--dry-run", action="store_true",
+            help="Validate the bulk file and print the command plan without connecting.")
+    parser.add_argument("-s", "--sessions", type=int, default=1, metavar='',
+            help="Maximum SSH sessions per switch in batch mode (default 1).")
+    parser.add_argument("-c", "--converge", action="store_true",
+            help="Diff the bulk file against the switch and push only what is missing instead of refusing existing VLANs.")
+    parser.add_argument("-r", "--resume", action="store_true",
+            help="Skip rows a previous run finished and re-apply the one in flight.")
+    parser.add_argument("--journal-dir", default=".", metavar='',
+            help="Directory for the per-host journals of completed rows (default current directory).")
+    parser.add_argument("-d", "--delivery", choices=["cli", "file"], default="cli",
+            help="Push config over the CLI, or copy one rendered file to the switch and merge it (default cli).")
+    parser.add_argument("--file-system", metavar='',
+            help="Where file delivery puts the config (default flash: on IOS, bootflash: on NX-OS).")
+    parser.add_argument("-P", "--port", type=int, default=22, metavar='',
+            help="SSH port (default 22).")
+    parser.add_argument("-t", "--transport", choices=["ssh", "nxapi"], default="ssh",
+            help="Transport for NX-OS switches (default ssh).")
+    parser.add_argument("--nxapi-port", type=int, metavar='',
+            help="NX-API port (default 443, or 80 with --nxapi-http).")
+    parser.add_argument("--nxapi-http", action="store_true",
+            help="Use plain HTTP for NX-API, e.g. against a lab or stand-in server.")
+    parser.add_argument("-k", "--insecure", action="store_true",
+            help="Don't verify the NX-API certificate.")
+    parser.add_argument("--cache-ttl", type=int, default=86400, metavar='',
+            help="Seconds to trust cached VTP/feature/version probes, 0 to disable (default 86400).")
+    parser.add_argument("--refresh", action="store_true",
+            help="Ignore the capability cache and probe the switch again.")
+    args = parser.parse_args()
+
+    if args.inventory:
+        inventory = read_inventory(args.inventory, args.platform)
+    elif args.host:
+        if args.platform is None:
+            parser.error("--platform is required with a host")
+        inventory = [(args.host, args.platform)]
+    else:
+        parser.error("a host or an inventory file is required")
+
+    # Validate the whole bulk file before any SSH session opens.
+    numbers, table, errors = load_plan(args.file)
+    errors += validate_plan(numbers, table, set(platform for _, platform in inventory))
+    if errors:
+        for error in errors:
+            print(error)
+        print(str(len(errors)) + " problems found in " + args.file.name + ". Nothing was pushed.")
+        sys.exit(1)
+    rows = plan_rows(table)
+    plan_id = get_plan_id(table)
+
+    if args.dry_run:
+        print_plan(rows, args.chunk_size)
+        sys.exit()
+
+    # Credentials are shared by every switch, so only prompt once.
+    username = getpass.getuser()
+    password = getpass.getpass()
+
+    # Device info.
+    switches = []
+    for host, platform in inventory:
+        cisco_switch = {
+                'device_type':  PLATFORMS[platform],
+                'host': host,
+                'port': args.port,
+                'username': username,
+                'password': password
+                }
+        switches.append(cisco_switch)
+
+    # Deploy to the switches through a bounded worker pool.
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        results = list(pool.map(lambda switch, platform: deploy_switch(switch, platform, rows, plan_id, args),
+                                switches, [platform for _, platform in inventory]))
+
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
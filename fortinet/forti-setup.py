@@ -1,12 +1,26 @@
 #!/bin/python3
 
 import argparse
+import csv
 import getpass
+import re
+import string
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from netmiko import ConnectHandler
+from netmiko import ConnectHandler, NetmikoTimeoutException, ReadTimeout
 
 # This script is extremely dangerous. Check where you are running it.
 
+# Templates already read and parsed, by path. Every unit on the same template shares one.
+TEMPLATES = {}
+TEMPLATE_LOCK = threading.Lock()
+
+# Output that means FortiOS rejected a line.
+CONF_ERRORS = ("Command fail", "Unknown action", "parse error", "entry not found in datasource", "node_check_object fail", "MUST be set", "Invalid")
+
 def check_reset(net_connect):
     # This doesn't work after a factory reset because no SSH access.
     # Check if config-touched=0 before proceeding.
@@ -30,20 +44,224 @@ def check_reset(net_connect):
     else:
         return True
 
-def install_conf(net_connect):
-    # Open the conf file.
-    with open('forti.conf', 'r') as file:
-        conf = file.read()
-    output = net_connect.send_command(conf)
-    print(output)
+def iter_blocks(lines):
+    # Yield the config one top level config ... end block at a time, nested config sections included.
+    # Lines outside any block go on their own; comments and blank lines are dropped.
+    block = []
+    depth = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        block.append(line)
+        if line.startswith("config "):
+            depth += 1
+        elif line == "end":
+            depth -= 1
+        if depth <= 0:
+            yield block
+            block = []
+            depth = 0
+    if block:
+        yield block
+
+def iter_batches(blocks, batch_size):
+    # Group whole blocks into batches of about batch_size lines; a bigger block goes alone.
+    batch = []
+    count = 0
+    for block in blocks:
+        if batch and count + len(block) > batch_size:
+            yield batch
+            batch = []
+            count = 0
+        batch.append(block)
+        count += len(block)
+    if batch:
+        yield batch
+
+def get_prompt(hostnames):
+    # Prompt of any of hostnames, e.g. FGT # or FGT (interface) #.
+    return "(?:" + "|".join(re.escape(hostname) for hostname in hostnames) + r")[^\n#]*#"
+
+def send_batch(net_connect, lines, read_timeout, retries):
+    # Write a batch at once and read back one prompt per line, so each line's output is exactly its own.
+    # A timing based read returns at the first quiet gap and hands a slow block's output to the next batch.
+    # A slow line is waited on again rather than sent twice: FortiOS lines aren't always idempotent (edit 0).
+    # Returns the output of every line, in line order.
+    net_connect.write_channel("".join(line + net_connect.RETURN for line in lines))
+    hostnames = [net_connect.base_prompt]
+    outputs = []
+    for line in lines:
+        for retry in range(retries + 1):
+            try:
+                outputs.append(net_connect.read_until_pattern(pattern=get_prompt(hostnames), read_timeout=read_timeout))
+                break
+            except (ReadTimeout, NetmikoTimeoutException):
+                if retry == retries:
+                    raise
+                print(net_connect.host + ": still waiting for the prompt after " + line)
+        # A template that sets the hostname changes the prompt from here on, old and new are both accepted.
+        words = line.split()
+        if len(words) == 3 and words[:2] == ["set", "hostname"]:
+            hostnames.append(words[2].strip("\"'"))
+
+    if len(hostnames) > 1:
+        net_connect.set_base_prompt()
+    return outputs
+
+def get_block_errors(batch, outputs):
+    # Error lines of a batch, each tied to the block of the line whose output it is in.
+    # Echoes of the sent lines are skipped, a set comments "Invalid ..." is not an error.
+    errors = []
+    lines = [(block[0], line) for block in batch for line in block]
+    for (header, line), output in zip(lines, outputs):
+        for text in output.splitlines():
+            stripped = text.strip()
+            if stripped.endswith(line):
+                continue
+            if any(error in stripped for error in CONF_ERRORS):
+                errors.append((header, stripped))
+
+    return errors
+
+def install_conf(net_connect, conf, log, batch_size=200, read_timeout=120, retries=3):
+    # Stream conf (any iterable of lines) to the FortiGate block by block, in batches of about batch_size lines.
+    # Only the current batch is held, so memory stays flat whatever the size of the config.
+    # Output goes to log as it comes. Returns the blocks sent and the (block, error) pairs found.
+    start = time.monotonic()
+    blocks = 0
+    lines = 0
+    errors = []
+    for batch in iter_batches(iter_blocks(conf), batch_size):
+        batch_lines = [line for block in batch for line in block]
+        outputs = send_batch(net_connect, batch_lines, read_timeout, retries)
+        log.write("".join(outputs) + "\n")
+        errors += get_block_errors(batch, outputs)
+        blocks += len(batch)
+        lines += len(batch_lines)
+
+    elapsed = time.monotonic() - start
+    print(net_connect.host + ": {} blocks, {} lines in {:.1f}s ({:.1f} blocks/s), {} errors.".format(
+        blocks, lines, elapsed, blocks / elapsed if elapsed else 0, len(errors)))
+    for block, error in errors:
+        print(net_connect.host + ": " + block + ": " + error)
+
+    return blocks, errors
+
+def get_template(path):
+    # Read and parse a template once, however many units use it.
+    with TEMPLATE_LOCK:
+        if path not in TEMPLATES:
+            with open(path, 'r') as file:
+                TEMPLATES[path] = string.Template(file.read())
+        return TEMPLATES[path]
+
+def render_conf(path, variables):
+    # Config for one unit: the template with its $variables filled in from the inventory.
+    # A variable the template uses but the inventory lacks raises KeyError.
+    return get_template(path).substitute(variables)
+
+def read_inventory(file, default_template):
+    # Inventory is a CSV with a header line: host, optionally template, then one column per variable.
+    # Lines starting with # are ignored.
+    reader = csv.DictReader(line for line in file if line.strip() and not line.startswith("#"))
+    if reader.fieldnames is None or 'host' not in reader.fieldnames:
+        print("Inventory needs a header line with a host column.")
+        sys.exit(1)
+
+    units = []
+    for row in reader:
+        variables = dict((key.strip(), (value or "").strip()) for key, value in row.items() if key is not None)
+        variables['template'] = variables.get('template') or default_template
+        units.append(variables)
+
+    return units
+
+def provision_unit(unit, password, batch_size, read_timeout):
+    # Render, check and install one unit. Any failure ends up in the result instead of stopping the bench.
+    host = unit['host']
+    result = {'host': host, 'template': unit['template'], 'status': "Installed"}
+    start = time.monotonic()
+    net_connect = None
+
+    try:
+        try:
+            conf = render_conf(unit['template'], unit)
+        except KeyError as e:
+            raise ValueError("template variable " + str(e) + " missing")
+
+        fortinet = {
+                'device_type': 'fortinet',
+                'host':         host,
+                'username':     'admin',
+                'password':     password,
+                }
+        net_connect = ConnectHandler(**fortinet)
+
+        if not check_reset(net_connect):
+            result['status'] = "Skipped, not factory default"
+            return result
+
+        # Units install side by side, so their output goes to a log each instead of the screen.
+        with open("forti-setup_" + host + ".log", "w") as f:
+            _, errors = install_conf(net_connect, conf.splitlines(), f, batch_size, read_timeout)
+        if errors:
+            result['status'] = "Installed, {} errors".format(len(errors))
+    except Exception as e:
+        message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+        result['status'] = "Error: " + message
+    finally:
+        # Disconnect the SSH connection.
+        if net_connect is not None:
+            net_connect.disconnect()
+        result['time'] = time.monotonic() - start
+        print(host + ": " + result['status'] + " in {:.1f}s".format(result['time']))
+
+    return result
+
+def print_results(results, elapsed):
+    # Timing and outcome per unit.
+    print()
+    print("{:<20} {:<24} {:>8}  {}".format("HOST", "TEMPLATE", "TIME", "STATUS"))
+    for result in results:
+        print("{:<20} {:<24} {:>7.1f}s  {}".format(result['host'], result['template'], result['time'], result['status']))
+    installed = sum(1 for result in results if result['status'] == "Installed")
+    print("{} of {} units installed cleanly in {:.1f}s ({:.1f}s one at a time).".format(
+        installed, len(results), elapsed, sum(result['time'] for result in results)))
 
 def main():
     
     # Create the parser and required arguments.
     parser = argparse.ArgumentParser()
-    parser.add_argument("host", help="FortiGate IP address.")
+    parser.add_argument("host", nargs='?', help="FortiGate IP address.")
+    parser.add_argument("-i", "--inventory", type=argparse.FileType('r'),
+            help="CSV of units to provision at once: host, optionally template, then template variables.")
+    parser.add_argument("-c", "--conf", default="forti.conf", metavar='',
+            help="Config file, or default template for the inventory (default forti.conf).")
+    parser.add_argument("-w", "--workers", type=int, default=16, metavar='',
+            help="Maximum units provisioned at once (default 16).")
+    parser.add_argument("-b", "--batch-size", type=int, default=200, metavar='',
+            help="Config lines sent at once, whole config blocks at a time (default 200).")
+    parser.add_argument("-r", "--read-timeout", type=float, default=120, metavar='',
+            help="Seconds to wait for the prompt after each line, three times over (default 120).")
     args = parser.parse_args()
 
+    if args.host is None and args.inventory is None:
+        parser.error("give a host or an inventory")
+
+    if args.inventory is not None:
+        units = read_inventory(args.inventory, args.conf)
+
+        # Every unit on the bench shares the admin password, so only prompt once.
+        password = getpass.getpass()
+
+        # Check and install every unit through a bounded worker pool.
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+            results = list(pool.map(lambda unit: provision_unit(unit, password, args.batch_size, args.read_timeout), units))
+        print_results(results, time.monotonic() - start)
+        return
+
     fortinet = {
             'device_type': 'fortinet',
             'host':         args.host,
@@ -59,7 +277,9 @@ def main():
     if default_state:
         print("FortiGate is factory default.")
         print("Installing config...")
-        install_conf(net_connect)
+        # Open the conf file, it's streamed rather than read in one go.
+        with open(args.conf, 'r') as file:
+            install_conf(net_connect, file, sys.stdout, args.batch_size, args.read_timeout)
     elif not default_state:
         print("FortiGate is NOT factory default.")
 
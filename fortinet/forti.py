@@ -3,10 +3,20 @@
 import argparse
 import datetime
 import getpass
+import ipaddress
+import os
 import sys
+import time
 
 from netmiko import ConnectHandler
 
+# The interval and bitset engine is shared with palo/parules.py.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ruleindex import ANY_ADDRESS, ANY_SERVICE, PROTOCOLS, Dimension, Resolver, complement, get_address_key, split_line
+
+# Sections that group other objects, so references through them can be followed up to the policies.
+GROUP_SECTIONS = ('firewall addrgrp', 'firewall addrgrp6', 'firewall service group', 'firewall vipgrp', 'system zone')
+
 def send(net_connect, command):
     output = (net_connect.send_command(command))
     print(output)
@@ -32,17 +42,334 @@ def backup_config(net_connect):
         for line in backup:
             f.write(line)
 
+
+def new_node():
+    return {'set': {}, 'config': {}, 'edit': {}}
+
+
+def parse_backup(file):
+    # Turn a FortiGate config into nested nodes, one pass and one line at a time.
+    # A node has its set attributes, its config sections by name and its edit entries by name, in file order.
+    root = new_node()
+    stack = [('config', root)]
+    for line in file:
+        tokens = split_line(line.strip())
+        if not tokens or tokens[0].startswith("#"):
+            continue
+        node = stack[-1][1]
+        if tokens[0] == "config":
+            section = node['config'].setdefault(" ".join(tokens[1:]), new_node())
+            stack.append(('config', section))
+        elif tokens[0] == "edit" and len(tokens) > 1:
+            entry = node['edit'].setdefault(tokens[1], new_node())
+            stack.append(('edit', entry))
+        elif tokens[0] == "next" and stack[-1][0] == 'edit':
+            stack.pop()
+        elif tokens[0] == "end" and len(stack) > 1:
+            # Tolerate a missing next before the end.
+            if stack[-1][0] == 'edit':
+                stack.pop()
+            stack.pop()
+        elif tokens[0] == "set" and len(tokens) > 1:
+            node['set'][tokens[1]] = tokens[2:]
+        elif tokens[0] == "append" and len(tokens) > 1:
+            node['set'].setdefault(tokens[1], []).extend(tokens[2:])
+
+    return root
+
+
+def get_sections(root, vdom=None):
+    # Config sections of one VDOM, or of the whole config when VDOMs aren't enabled.
+    vdoms = root['config'].get('vdom', {'edit': {}})['edit']
+    if not vdoms:
+        return root['config']
+    name = vdom or ("root" if "root" in vdoms else next(iter(vdoms)))
+    if name not in vdoms:
+        print("No VDOM " + name + ", there is " + ", ".join(vdoms) + ".")
+        sys.exit(1)
+    # The same VDOM can appear twice in a backup, its objects are merged on parse.
+    return vdoms[name]['config']
+
+
+def get_range(low, high):
+    return get_address_key(ipaddress.ip_address(low)), get_address_key(ipaddress.ip_address(high))
+
+
+def get_address_interval(settings, six=False):
+    # Interval of an address, address6 or VIP entry, None for fqdn, geography, wildcard, dynamic and friends.
+    # Backups leave out defaults, so an ipmask address without a subnet (all) covers everything.
+    try:
+        if 'extip' in settings:
+            # VIPs match on their external address, the one policies see before the NAT.
+            low, _, high = settings['extip'][0].partition("-")
+            return get_range(low, high or low)
+        kind = settings.get('type', ["ipprefix" if six else "ipmask"])[0]
+        if kind == "iprange" and 'start-ip' in settings:
+            return get_range(settings['start-ip'][0], settings.get('end-ip', settings['start-ip'])[0])
+        if six and kind == "ipprefix":
+            network = ipaddress.ip_network(settings.get('ip6', ["::/0"])[0], strict=False)
+        elif not six and kind in ("ipmask", "interface-subnet"):
+            network = ipaddress.ip_network("/".join(settings.get('subnet', ["0.0.0.0", "0.0.0.0"])[:2]), strict=False)
+        else:
+            return None
+        return get_address_key(network.network_address), get_address_key(network.broadcast_address)
+    except ValueError:
+        return None
+
+
+def get_service_intervals(settings):
+    # Intervals of a custom service: tcp/udp/sctp port ranges (DST[-DST][:SRC]), or a whole IP protocol.
+    # None if the service can't be placed.
+    protocol = settings.get('protocol', ["TCP/UDP/SCTP"])[0].upper()
+    if protocol == "IP":
+        number = int(settings.get('protocol-number', ["0"])[0])
+        return ANY_SERVICE if number == 0 else [(number << 16, number << 16 | 0xffff)]
+    if protocol in ("ICMP", "ICMP6"):
+        number = 1 if protocol == "ICMP" else 58
+        return [(number << 16, number << 16 | 0xffff)]
+
+    intervals = []
+    for name, number in (('tcp-portrange', 6), ('udp-portrange', 17), ('sctp-portrange', 132)):
+        for port in settings.get(name, []):
+            low, _, high = port.split(":")[0].partition("-")
+            try:
+                intervals.append((number << 16 | int(low), number << 16 | int(high or low)))
+            except ValueError:
+                return None
+    return intervals
+
+
+class PolicyIndex:
+    # Indexed FortiGate policies, the Nth policy in config order being bit N of every bitset.
+    # Lookups bisect each dimension and AND the bitsets; the first matching policy is the lowest bit.
+
+    def __init__(self, sections):
+        addresses = {}
+        for name in ('firewall address', 'firewall address6', 'firewall vip', 'firewall vip6'):
+            for entry, node in sections.get(name, new_node())['edit'].items():
+                # address and address6 both have an all, a name can stand for both families.
+                interval = get_address_interval(node['set'], name.endswith("6"))
+                if interval is not None:
+                    addresses[entry] = (addresses.get(entry) or []) + [interval]
+                else:
+                    addresses.setdefault(entry, None)
+        address_groups = {}
+        for name in ('firewall addrgrp', 'firewall addrgrp6', 'firewall vipgrp', 'firewall vipgrp6'):
+            for entry, node in sections.get(name, new_node())['edit'].items():
+                address_groups[entry] = node['set'].get('member', [])
+        services = {}
+        for entry, node in sections.get('firewall service custom', new_node())['edit'].items():
+            services[entry] = get_service_intervals(node['set'])
+        service_groups = dict((entry, node['set'].get('member', []))
+                              for entry, node in sections.get('firewall service group', new_node())['edit'].items())
+        # VIPs with a mapped address by their external one, the Nth being bit N, for the "via VIP" note.
+        self.vips = []
+        vip_addresses = []
+        for entry, node in sections.get('firewall vip', new_node())['edit'].items():
+            interval = get_address_interval(node['set'])
+            if interval is not None and 'mappedip' in node['set']:
+                self.vips.append((entry, node['set']['mappedip'][0]))
+                vip_addresses.append([interval])
+        self.vip_addresses = Dimension(vip_addresses)
+
+        # An interface matches policies on it, on any zone it belongs to, and on any.
+        self.zones = {}
+        for zone, node in sections.get('system zone', new_node())['edit'].items():
+            for interface in node['set'].get('interface', []):
+                self.zones.setdefault(interface, []).append(zone)
+
+        address_resolver = Resolver(addresses, address_groups)
+        service_resolver = Resolver(services, service_groups)
+        self.policies = []
+        sources = []
+        destinations = []
+        ports = []
+        self.enabled = 0
+        self.conditional = 0
+        self.source_interfaces = {}
+        self.destination_interfaces = {}
+        for bit, (policy_id, node) in enumerate(sections.get('firewall policy', new_node())['edit'].items()):
+            settings = node['set']
+            policy = {'id': policy_id, 'name': " ".join(settings.get('name', [])), 'action': settings.get('action', ["deny"])[0], 'unresolved': []}
+            self.policies.append(policy)
+
+            for fields, negate, target in ((('srcaddr', 'srcaddr6'), 'srcaddr-negate', sources),
+                                           (('dstaddr', 'dstaddr6'), 'dstaddr-negate', destinations)):
+                names = [name for field in fields for name in settings.get(field, [])]
+                intervals, unresolved = address_resolver.resolve(names)
+                policy['unresolved'] += unresolved
+                if unresolved:
+                    intervals = ANY_ADDRESS
+                elif settings.get(negate) == ["enable"]:
+                    intervals = complement(intervals, ANY_ADDRESS)
+                target.append(intervals)
+
+            intervals, unresolved = service_resolver.resolve(settings.get('service', []))
+            policy['unresolved'] += unresolved
+            if unresolved:
+                intervals = ANY_SERVICE
+            elif settings.get('service-negate') == ["enable"]:
+                intervals = complement(intervals, ANY_SERVICE)
+            ports.append(intervals)
+
+            for field, index in (('srcintf', self.source_interfaces), ('dstintf', self.destination_interfaces)):
+                for interface in settings.get(field, ["any"]):
+                    index[interface] = index.get(interface, 0) | 1 << bit
+
+            if settings.get('status') != ["disable"]:
+                self.enabled |= 1 << bit
+            # Unresolved objects were widened to any; users, groups and schedules aren't indexed at all.
+            if policy['unresolved'] or any(field in settings for field in ('users', 'groups', 'fsso-groups')) \
+                    or settings.get('schedule', ["always"]) != ["always"]:
+                self.conditional |= 1 << bit
+
+        self.sources = Dimension(sources)
+        self.destinations = Dimension(destinations)
+        self.services = Dimension(ports)
+
+    def get_vip(self, destination):
+        # First VIP whose external address covers destination, as (name, mapped address), or None.
+        bits = self.vip_addresses.lookup(get_address_key(ipaddress.ip_address(destination)))
+        return self.vips[(bits & -bits).bit_length() - 1] if bits else None
+
+    def get_interface_bits(self, index, interface):
+        bits = index.get("any", 0) | index.get(interface, 0)
+        for zone in self.zones.get(interface, []):
+            bits |= index.get(zone, 0)
+        return bits
+
+    def lookup(self, source_interface, destination_interface, source, destination, protocol, port):
+        # First policy matching the flow, and the earlier policies that might match first depending on
+        # users, groups, schedules or unresolved objects. Returns (policy or None, [policies]).
+        protocol = PROTOCOLS.get(protocol, int(protocol) if protocol.isdigit() else 0)
+        candidates = (self.enabled
+                      & self.get_interface_bits(self.source_interfaces, source_interface)
+                      & self.get_interface_bits(self.destination_interfaces, destination_interface)
+                      & self.sources.lookup(get_address_key(ipaddress.ip_address(source)))
+                      & self.destinations.lookup(get_address_key(ipaddress.ip_address(destination)))
+                      & self.services.lookup(protocol << 16 | port))
+        certain = candidates & ~self.conditional
+        first = certain & -certain
+        maybe = candidates & (first - 1) if first else candidates
+        policies = []
+        while maybe:
+            lowest = maybe & -maybe
+            policies.append(self.policies[lowest.bit_length() - 1])
+            maybe ^= lowest
+
+        return (self.policies[first.bit_length() - 1] if first else None), policies
+
+
+def index_references(sections):
+    # Every place an object name is used: {name: [(section, entry, attribute)]}.
+    # Built once over all sections, nested ones included, so a lookup is a dict get.
+    references = {}
+
+    def walk(path, node, entry):
+        for attribute, values in node['set'].items():
+            for value in values:
+                references.setdefault(value, []).append((path, entry, attribute))
+        for name, section in node['config'].items():
+            walk((path + " " + name).strip() if entry is None else path, section, entry)
+        for name, child in node['edit'].items():
+            walk(path, child, name if entry is None else entry + " > " + name)
+
+    for name, section in sections.items():
+        walk(name, section, None)
+
+    return references
+
+
+def find_references(references, name):
+    # Direct references to name, and the policies reaching it through groups and zones.
+    direct = references.get(name, [])
+    policies = []
+    seen = set([name])
+    queue = [name]
+    while queue:
+        current = queue.pop()
+        for section, entry, attribute in references.get(current, []):
+            if section == "firewall policy" and current != name:
+                policies.append((entry, current))
+            elif section in GROUP_SECTIONS and entry not in seen:
+                seen.add(entry)
+                queue.append(entry)
+
+    return direct, policies
+
+
+def parse_query(query):
+    # SRCINTF DSTINTF SOURCE DESTINATION PROTOCOL/PORT
+    fields = query.split()
+    if len(fields) != 5:
+        raise ValueError("expected SRCINTF DSTINTF SOURCE DESTINATION PROTOCOL/PORT: " + query)
+    protocol, _, port = fields[4].partition("/")
+    return fields[0], fields[1], fields[2], fields[3], protocol.lower(), int(port or 0)
+
+
+def offline(args):
+    # Answer the queries and reference lookups from a backup file, nothing is sent to a FortiGate.
+    start = time.monotonic()
+    with open(args.file, 'r') as file:
+        sections = get_sections(parse_backup(file), args.vdom)
+    index = PolicyIndex(sections)
+    references = index_references(sections)
+    print("Indexed {} policies, {} names in {:.2f}s.".format(len(index.policies), len(references), time.monotonic() - start))
+
+    if args.query:
+        print()
+        print("{:<60} {:<30} {:>8}  {}".format("FLOW", "POLICY", "TIME", "MAY MATCH FIRST"))
+    for query in args.query:
+        try:
+            flow = parse_query(query)
+            start = time.perf_counter()
+            policy, maybe = index.lookup(*flow)
+            elapsed = time.perf_counter() - start
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            continue
+        if policy is None:
+            matched = "(implicit deny)"
+        else:
+            matched = " ".join(field for field in (policy['id'], policy['name'], "(" + policy['action'] + ")") if field)
+            vip = index.get_vip(flow[3])
+            if vip is not None:
+                matched += " via VIP " + vip[0] + " -> " + vip[1]
+        print("{:<60} {:<30} {:>6.0f}us  {}".format(query, matched, elapsed * 1e6, " ".join(other['id'] for other in maybe)))
+
+    for name in args.references:
+        direct, policies = find_references(references, name)
+        print()
+        print(name + ": " + str(len(direct)) + " direct references")
+        for section, entry, attribute in direct:
+            print("    " + section + " " + entry + " " + attribute)
+        for policy, through in policies:
+            print("    firewall policy " + policy + " through " + through)
+
 def main():
     # Create the parser and arguments.
     parser = argparse.ArgumentParser()
-    parser.add_argument("host", help="FortiGate IP address.")
-    parser.add_argument("username", help="Username")
+    parser.add_argument("host", nargs='?', help="FortiGate IP address.")
+    parser.add_argument("username", nargs='?', help="Username")
     parser.add_argument("-a", "--admin") # Create admin
     parser.add_argument("-b", "--backup", action="store_true", 
             help="Backup the startup config.")
     parser.add_argument("-t", "--trace") # Trace stuff
+    parser.add_argument("-f", "--file", metavar='',
+            help="Work offline on this backup instead of connecting.")
+    parser.add_argument("-q", "--query", action="append", default=[], metavar='',
+            help='With --file, policy matching "SRCINTF DSTINTF SOURCE DESTINATION PROTOCOL/PORT". Can be repeated.')
+    parser.add_argument("-r", "--references", action="append", default=[], metavar='',
+            help="With --file, where an object is used. Can be repeated.")
+    parser.add_argument("--vdom", metavar='', help="With --file, VDOM to look in (default root).")
     args = parser.parse_args()
 
+    if args.file is not None:
+        offline(args)
+        sys.exit()
+    if args.host is None or args.username is None:
+        parser.error("give a host and username, or --file")
+
     # Device info.
     fortinet = {
             'device_type':  'fortinet',
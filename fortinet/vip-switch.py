@@ -1,59 +1,438 @@
 #!/bin/python3
-# This script is intended to change the destination VIP on a specific policy and had a specific use case. 
+# This script is intended to change the destination VIP on a specific policy and had a specific use case.
 # I've removed the specifics and made the script more generic. Modifications needed.
+#
+# With --serve it stays up with a warm session to the FortiGate (SSH, or the REST API with --api)
+# and takes switch requests on a local HTTP port or Unix socket, e.g.
+#   curl -X POST http://127.0.0.1:8080/switch -d vip-2
+#   echo vip-2 | nc -U /run/vip-switch.sock
+#
+# With --manifest it retargets many policies on many FortiGates at once, one session per FortiGate.
+import argparse
+import csv
 import getpass
+import http.client
+import json
+import os
+import re
+import socket
+import socketserver
+import ssl
 import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-from netmiko import ConnectHandler
+from netmiko import ConnectHandler, NetmikoTimeoutException, ReadTimeout
+from paramiko.ssh_exception import SSHException
 
-def connect_fortigate(choice):
+# Output that means FortiOS rejected a line.
+CONF_ERRORS = ("Command fail", "Unknown action", "parse error", "entry not found in datasource", "node_check_object fail")
+
+# What a dropped or wedged SSH session raises.
+SESSION_ERRORS = (IOError, EOFError, OSError, SSHException, ReadTimeout, NetmikoTimeoutException)
+
+# Change to match the names of the VIPs on the FortiGate.
+VIPS = ['vip-1', 'vip-2', 'vip-3']
+
+
+def connect_fortigate(choice, args):
     # Connect to FortiGate
 
-    fortinet = { # Update all these or add argparser.
+    # Choices are numbered from 1 in the order of --vip.
+    vips = args.vip or VIPS
+    if choice.isdigit() and 1 <= int(choice) <= len(vips):
+        domain = vips[int(choice) - 1]
+    else:
+        print("invalid")
+        return
+
+    fortinet = {
             'device_type':  'fortinet',
-            'host':         '192.168.1.99',
-            'username':     'admin',
+            'host':         args.host,
+            'username':     args.username,
             'password':     getpass.getpass(),
             }
 
     print("Connecting to FortiGate...")
     net_connect = ConnectHandler(**fortinet)
 
-    # Change to match the name of the VIP on the FortiGate.
-    if choice == "1":
-        domain = "vip-1"
-    elif choice == "2":
-        domain = "vip-2"
-    elif choice == "3":
-        domain = "vip-3"
-    else:
-        print("invalid")
-
     # Send command to FortiGate.
     if domain:
         try:
             # Update these to match the correct policy on firewall.
             print("Changing destination to " + domain + "...")
             debug = net_connect.send_command("config firewall policy", expect_string=r"policy", strip_prompt=False, strip_command=False)
-            debug += net_connect.send_command("edit 3", expect_string=r"3", strip_prompt=False, strip_command=False)
-            debug += net_connect.send_command("set dstaddr '" + domain + "'", expect_string=r"3", strip_prompt=False, strip_command=False)
+            debug += net_connect.send_command("edit " + args.policy, expect_string=re.escape(args.policy), strip_prompt=False, strip_command=False)
+            debug += net_connect.send_command("set dstaddr '" + domain + "'", expect_string=re.escape(args.policy), strip_prompt=False, strip_command=False)
             debug += net_connect.send_command("end", expect_string=r"#", strip_prompt=False, strip_command=False)
             print(debug)
         except (IOError, EOFError) as e:
             print(e)
 
 
+def send_lines(net_connect, commands, read_timeout):
+    # Write every command at once and read back one prompt per command.
+    # send_config_set with cmd_verify off waits out a 2 s quiet gap instead, and returns early on a slow line.
+    # Returns the output of each command, its echo included, in command order.
+    net_connect.write_channel("".join(command + net_connect.RETURN for command in commands))
+    prompt = re.escape(net_connect.base_prompt) + r"[^\n#]*#"
+    return [net_connect.read_until_pattern(pattern=prompt, read_timeout=read_timeout) for _ in commands]
+
+
+class WarmSession:
+    # SSH session kept logged in and kept alive, so a switch is a single round trip.
+    # The lock keeps the keep-alive and the switches from talking over each other.
+
+    def __init__(self, fortinet, policy, keepalive=30, read_timeout=10):
+        self.fortinet = fortinet
+        self.policy = policy
+        self.keepalive = keepalive
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.net_connect = None
+
+    def connect(self):
+        if self.net_connect is not None:
+            try:
+                self.net_connect.disconnect()
+            except Exception:
+                pass
+        self.net_connect = ConnectHandler(**self.fortinet)
+
+    def send(self, commands):
+        return "".join(send_lines(self.net_connect, commands, self.read_timeout))
+
+    def keep_alive(self):
+        # Poke the session every keepalive seconds and log back in if it died.
+        while True:
+            time.sleep(self.keepalive)
+            with self.lock:
+                try:
+                    self.net_connect.find_prompt()
+                except Exception:
+                    print("Session dropped, reconnecting...")
+                    try:
+                        self.connect()
+                    except Exception as e:
+                        message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+                        print("Reconnect failed: " + message)
+
+    def switch(self, domain):
+        # Point the policy at domain, logging back in once if the session is gone.
+        commands = ["config firewall policy", "edit " + str(self.policy), "set dstaddr '" + domain + "'", "end"]
+        with self.lock:
+            try:
+                output = self.send(commands)
+            except SESSION_ERRORS:
+                # set dstaddr is idempotent, so a fresh session can run the whole switch again.
+                self.connect()
+                output = self.send(commands)
+        errors = [line.strip() for line in output.splitlines() if any(error in line for error in CONF_ERRORS)]
+        if errors:
+            raise ValueError("; ".join(errors))
+
+
+class WarmApi:
+    # FortiOS REST API session over one kept-alive HTTPS connection.
+
+    def __init__(self, host, port, token, policy, scheme="https", verify=True, keepalive=30, timeout=10):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.policy = policy
+        self.scheme = scheme
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.context = None
+        if scheme == "https" and not verify:
+            # FortiGates usually run with a self-signed management certificate.
+            self.context = ssl.create_default_context()
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        if self.scheme == "https":
+            self.connection = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.context)
+        else:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.connection.connect()
+        # Headers and body go out as separate writes, Nagle would hold the body back for the delayed ACK.
+        self.connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self, method, path, body=None):
+        # Send a call on the warm connection, reconnecting once if the firewall closed it.
+        headers = {'Authorization': "Bearer " + self.token, 'Content-Type': "application/json"}
+        data = json.dumps(body).encode() if body is not None else None
+        for attempt in range(2):
+            try:
+                self.connection.request(method, path, body=data, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, json.loads(response.read() or b"{}")
+            except (http.client.HTTPException, OSError):
+                if attempt:
+                    raise
+                self.connect()
+
+    def keep_alive(self):
+        # Cheap call every keepalive seconds so the connection and the TLS session stay open.
+        while True:
+            time.sleep(self.keepalive)
+            with self.lock:
+                try:
+                    self.request("GET", "/api/v2/monitor/system/status")
+                except Exception:
+                    # The next switch reconnects.
+                    pass
+
+    def switch(self, domain):
+        path = "/api/v2/cmdb/firewall/policy/" + urllib.parse.quote(str(self.policy))
+        with self.lock:
+            status, result = self.request("PUT", path, {'dstaddr': [{'name': domain}]})
+        if status != 200 or result.get('status') != "success":
+            raise ValueError("REST API returned " + str(status) + " " + str(result.get('cli_error') or result.get('error') or ""))
+
+
+def handle_switch(session, domain, vips):
+    # Run one switch request and time it. Returns the response sent back to the client.
+    if domain not in vips:
+        return {'vip': domain, 'status': "error", 'error': "unknown VIP, expected one of " + ", ".join(vips)}
+    start = time.perf_counter()
+    try:
+        session.switch(domain)
+        response = {'vip': domain, 'status': "OK"}
+    except Exception as e:
+        message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+        response = {'vip': domain, 'status': "error", 'error': message}
+    response['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    print(time.strftime("%H:%M:%S") + " switch to " + domain + ": " + response['status'] + " in " + str(response['latency_ms']) + " ms")
+
+    return response
+
+
+def serve(session, vips, port=None, socket_path=None):
+    # Take switch requests until killed: POST /switch with the VIP as body on 127.0.0.1:port,
+    # or one VIP per line on the Unix socket. Either answers with JSON including the latency.
+    class HttpHandler(BaseHTTPRequestHandler):
+        # Answer as soon as the switch is done rather than after the client's delayed ACK.
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, code, body):
+            data = (json.dumps(body) + "\n").encode()
+            self.send_response(code)
+            self.send_header('Content-Type', "application/json")
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.reply(200, {'status': "OK", 'vips': vips})
+
+        def do_POST(self):
+            if self.path.split("?")[0] != "/switch":
+                self.reply(404, {'status': "error", 'error': "POST /switch"})
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode().strip()
+            domain = body or urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query).get('vip', [""])[0]
+            response = handle_switch(session, domain, vips)
+            self.reply(200 if response['status'] == "OK" else 400, response)
+
+    class SocketHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                domain = line.decode().strip()
+                if domain:
+                    self.wfile.write((json.dumps(handle_switch(session, domain, vips)) + "\n").encode())
+
+    servers = []
+    if port is not None:
+        servers.append(ThreadingHTTPServer(('127.0.0.1', port), HttpHandler))
+        print("Listening on http://127.0.0.1:" + str(port) + "/switch")
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, SocketHandler)
+        # Clients can hold their connection open, they shouldn't keep us from exiting.
+        server.daemon_threads = True
+        servers.append(server)
+        print("Listening on " + socket_path)
+
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in servers]
+    threads.append(threading.Thread(target=session.keep_alive, daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+        if socket_path is not None:
+            os.remove(socket_path)
+
+
+def read_manifest(file):
+    # Manifest lines are FIREWALL,POLICY ID,DSTADDR. Repeat a firewall and policy to give it several addresses.
+    # Blank lines and lines starting with # are ignored.
+    # Returns {firewall: {policy: [dstaddr]}} in manifest order.
+    firewalls = {}
+    for number, row in enumerate(csv.reader(file), 1):
+        if not row or not row[0].strip() or row[0].strip().startswith("#"):
+            continue
+        if len(row) != 3 or not row[1].strip().isdigit():
+            print("Line " + str(number) + ": expected FIREWALL,POLICY ID,DSTADDR.")
+            sys.exit(1)
+        firewall, policy, dstaddr = (field.strip() for field in row)
+        firewalls.setdefault(firewall, {}).setdefault(policy, []).append(dstaddr)
+
+    return firewalls
+
+
+def get_policy_ids(net_connect):
+    # IDs of the policies that exist. Editing a missing ID would create an empty policy instead.
+    output = net_connect.send_command("show firewall policy | grep edit")
+    return set(line.split()[1] for line in output.splitlines() if line.strip().startswith("edit ") and len(line.split()) > 1)
+
+
+def retarget_firewall(host, policies, username, password, read_timeout=120):
+    # Point every policy of one FortiGate at its new dstaddr in a single config firewall policy session.
+    # Any failure ends up in the results instead of stopping the other FortiGates.
+    results = dict((policy, {'host': host, 'policy': policy, 'dstaddr': " ".join(names), 'status': "OK"})
+                   for policy, names in policies.items())
+    start = time.monotonic()
+    net_connect = None
+
+    try:
+        fortinet = {
+                'device_type':  'fortinet',
+                'host':         host,
+                'username':     username,
+                'password':     password,
+                }
+        net_connect = ConnectHandler(**fortinet)
+
+        existing = get_policy_ids(net_connect)
+        # Commands paired with the policy they belong to, None for the section's config and end.
+        commands = [("config firewall policy", None)]
+        for policy, names in policies.items():
+            if policy not in existing:
+                results[policy]['status'] = "Policy not found"
+                continue
+            for command in ["edit " + policy, "set dstaddr " + " ".join("'" + name + "'" for name in names), "next"]:
+                commands.append((command, policy))
+        commands.append(("end", None))
+
+        if len(commands) > 2:
+            outputs = send_lines(net_connect, [command for command, _ in commands], read_timeout)
+
+            # Every output is its own command's, so errors go straight to that command's policy.
+            for (command, policy), output in zip(commands, outputs):
+                errors = [line.strip() for line in output.splitlines() if any(error in line for error in CONF_ERRORS)]
+                if errors and policy is not None and results[policy]['status'] == "OK":
+                    results[policy]['status'] = "Error: " + errors[0]
+    except Exception as e:
+        message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+        for result in results.values():
+            if result['status'] == "OK":
+                result['status'] = "Error: " + message
+    finally:
+        # Disconnect the SSH connection.
+        if net_connect is not None:
+            net_connect.disconnect()
+        elapsed = time.monotonic() - start
+        for result in results.values():
+            result['time'] = elapsed
+        print(host + ": {} policies in {:.1f}s".format(len(results), elapsed))
+
+    return list(results.values())
+
+
+def print_results(results, elapsed):
+    # Result per policy, then the total.
+    print()
+    print("{:<20} {:>8} {:<30} {:>8}  {}".format("FIREWALL", "POLICY", "DSTADDR", "TIME", "STATUS"))
+    for result in results:
+        print("{:<20} {:>8} {:<30} {:>7.1f}s  {}".format(result['host'], result['policy'], result['dstaddr'], result['time'], result['status']))
+    ok = sum(1 for result in results if result['status'] == "OK")
+    print("{} of {} policies retargeted in {:.1f}s.".format(ok, len(results), elapsed))
+
+
 def main():
-    print("Select a domain.\n")
-    print("1. VIP 1")
-    print("2. VIP 2")
-    print("3. VIP 3")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--serve", action="store_true",
+            help="Stay up with a warm session and take switch requests instead of prompting.")
+    parser.add_argument("--host", default="192.168.1.99", metavar='', help="FortiGate IP address (default 192.168.1.99).")
+    parser.add_argument("-u", "--username", default="admin", metavar='', help="Username (default admin).")
+    parser.add_argument("-p", "--policy", default="3", metavar='', help="Policy ID to switch (default 3).")
+    parser.add_argument("--vip", action="append", metavar='',
+            help="VIP the policy may be switched to. Can be repeated (default " + ", ".join(VIPS) + ").")
+    parser.add_argument("-l", "--listen", type=int, metavar='PORT', help="Local HTTP port for switch requests.")
+    parser.add_argument("--socket", metavar='PATH', help="Unix socket for switch requests.")
+    parser.add_argument("-k", "--keepalive", type=int, default=30, metavar='',
+            help="Seconds between keep-alives on the session (default 30).")
+    parser.add_argument("-a", "--api", action="store_true",
+            help="Switch through the FortiOS REST API with an API token instead of SSH.")
+    parser.add_argument("--api-port", type=int, metavar='', help="REST API port (default 443, or 80 with --api-http).")
+    parser.add_argument("--api-http", action="store_true",
+            help="Use plain HTTP for the REST API, e.g. against a lab or stand-in server.")
+    parser.add_argument("--insecure", action="store_true", help="Don't verify the REST API certificate.")
+    parser.add_argument("-m", "--manifest", type=argparse.FileType('r'), metavar='',
+            help="CSV of FIREWALL,POLICY ID,DSTADDR lines to retarget at once.")
+    parser.add_argument("-w", "--workers", type=int, default=8, metavar='',
+            help="Maximum FortiGates retargeted at once (default 8).")
+    args = parser.parse_args()
+
+    if args.manifest is not None:
+        firewalls = read_manifest(args.manifest)
+
+        # Every FortiGate shares the username, so only prompt once.
+        password = getpass.getpass()
 
-    choice = input ("Select: ")
+        # One session per FortiGate, through a bounded worker pool.
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+            results = list(pool.map(lambda host: retarget_firewall(host, firewalls[host], args.username, password), firewalls))
+        print_results([result for firewall in results for result in firewall], time.monotonic() - start)
+        return
 
-    connect_fortigate(choice)
+    if not args.serve:
+        print("Select a domain.\n")
+        for number, vip in enumerate(args.vip or VIPS, 1):
+            print(str(number) + ". " + vip)
 
-    # TODO Connect to SMTP server
+        choice = input ("Select: ")
+
+        connect_fortigate(choice, args)
+
+        # TODO Connect to SMTP server
+        return
+
+    if args.listen is None and args.socket is None:
+        parser.error("--serve needs --listen and/or --socket")
+    vips = args.vip or VIPS
+
+    if args.api:
+        session = WarmApi(args.host, args.api_port or (80 if args.api_http else 443), getpass.getpass("API token: "),
+                          args.policy, "http" if args.api_http else "https", not args.insecure, args.keepalive)
+    else:
+        fortinet = {
+                'device_type':  'fortinet',
+                'host':         args.host,
+                'username':     args.username,
+                'password':     getpass.getpass(),
+                }
+        session = WarmSession(fortinet, args.policy, args.keepalive)
+
+    print("Connecting to FortiGate...")
+    session.connect()
+    serve(session, vips, args.listen, args.socket)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,166 @@
+"""
+Description: Interval and bitset engine shared by palo/parules.py and fortinet/forti.py.
+Addresses and services become integer intervals, and every dimension of a
+rulebase is cut into elementary intervals at the rule boundaries, each
+interval holding a bitset of the rules covering it. A lookup is a bisect per
+dimension and an AND of the bitsets, the first matching rule being the lowest
+bit. A segment tree ANDs the bitsets over a run of intervals, which gives
+every rule covering a whole range without comparing rules pairwise.
+"""
+
+import bisect
+import shlex
+
+
+# NOTE IPv4 addresses are kept as is, IPv6 ones shifted past the IPv4 space, so both fit one integer dimension.
+V6_OFFSET = 1 << 32
+ANY_ADDRESS = [(0, V6_OFFSET + (1 << 128) - 1)]
+
+# Services are protocol number << 16 | port.
+ANY_SERVICE = [(0, (256 << 16) - 1)]
+PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17, 'sctp': 132}
+
+
+def split_line(line):
+    # Tokens of a config line, honouring quoted names and descriptions.
+    if '"' not in line and "'" not in line and "\\" not in line:
+        return line.split()
+    try:
+        return shlex.split(line)
+    except ValueError:
+        return line.split()
+
+
+def get_address_key(address):
+    # Integer position of an ip_address in the address dimension.
+    return int(address) + (V6_OFFSET if address.version == 6 else 0)
+
+
+def merge_intervals(intervals):
+    # Union of (low, high) intervals; overlapping and adjacent ones are joined.
+    merged = []
+    for low, high in sorted(intervals):
+        if merged and low <= merged[-1][1] + 1:
+            if high > merged[-1][1]:
+                merged[-1][1] = high
+        else:
+            merged.append([low, high])
+
+    return [tuple(interval) for interval in merged]
+
+
+def complement(intervals, universe):
+    # What universe has that intervals don't, for negated addresses and services.
+    low, high = universe[0]
+    gaps = []
+    for start, end in merge_intervals(intervals):
+        if start > low:
+            gaps.append((low, start - 1))
+        low = end + 1
+    if low <= high:
+        gaps.append((low, high))
+
+    return gaps
+
+
+class Resolver:
+    # Turns object names into intervals, following nested groups once each.
+    # An object is an interval, a list of them, or None when it can't be placed (fqdn, geography, ...).
+    # A group is a list of member names, or None when its members aren't known offline (dynamic groups).
+
+    def __init__(self, objects, groups):
+        self.objects = objects
+        self.groups = groups
+        self.cache = {}
+
+    def resolve(self, names, literal=None):
+        # Intervals of names and the names that couldn't be resolved.
+        # literal, when given, turns a name that isn't an object or a group into an interval or None.
+        intervals = []
+        unresolved = []
+        for name in names:
+            found, missing = self.resolve_name(name, literal, set())
+            intervals += found
+            unresolved += missing
+
+        return merge_intervals(intervals), unresolved
+
+    def resolve_name(self, name, literal, seen):
+        if name in self.cache:
+            return self.cache[name]
+        if name in seen:
+            return [], []
+        seen.add(name)
+
+        if name in self.objects:
+            value = self.objects[name]
+            result = ([] if value is None else (list(value) if isinstance(value, list) else [value]), [] if value is not None else [name])
+        elif name in self.groups and self.groups[name] is not None:
+            intervals = []
+            unresolved = []
+            for member in self.groups[name]:
+                found, missing = self.resolve_name(member, literal, seen)
+                intervals += found
+                unresolved += missing
+            result = (intervals, unresolved)
+        elif literal is not None and literal(name) is not None:
+            result = ([literal(name)], [])
+        else:
+            result = ([], [name])
+
+        self.cache[name] = result
+        return result
+
+
+class Dimension:
+    # One rule dimension cut into elementary intervals, each with the bitset of rules covering it.
+    # With tree set, a segment tree ANDs the bitsets over any run of intervals for covering().
+
+    def __init__(self, rule_intervals, tree=False):
+        points = set([0])
+        for intervals in rule_intervals:
+            for low, high in intervals:
+                points.add(low)
+                points.add(high + 1)
+        self.points = sorted(points)
+
+        # Every rule's intervals are disjoint, so toggling its bit at each boundary gives the running bitset.
+        deltas = [0] * len(self.points)
+        for bit, intervals in enumerate(rule_intervals):
+            for low, high in intervals:
+                deltas[bisect.bisect_left(self.points, low)] ^= 1 << bit
+                deltas[bisect.bisect_left(self.points, high + 1)] ^= 1 << bit
+        self.bits = []
+        running = 0
+        for delta in deltas:
+            running ^= delta
+            self.bits.append(running)
+
+        self.size = len(self.bits)
+        self.tree = None
+        if tree:
+            self.tree = [0] * self.size + self.bits
+            for node in range(self.size - 1, 0, -1):
+                self.tree[node] = self.tree[2 * node] & self.tree[2 * node + 1]
+
+    def lookup(self, value):
+        # Rules covering value.
+        return self.bits[bisect.bisect_right(self.points, value) - 1]
+
+    def covering(self, intervals, everyone):
+        # Rules covering every interval given, everyone when there are none.
+        result = everyone
+        for low, high in intervals:
+            left = bisect.bisect_right(self.points, low) - 1 + self.size
+            right = bisect.bisect_right(self.points, high) + self.size
+            while left < right and result:
+                if left & 1:
+                    result &= self.tree[left]
+                    left += 1
+                if right & 1:
+                    right -= 1
+                    result &= self.tree[right]
+                left >>= 1
+                right >>= 1
+
+        return result
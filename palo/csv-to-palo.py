@@ -1,33 +1,448 @@
 #!/usr/bin/env python3
- 
+
 """
 Author: Stefano Amodei <stefano.amodei@pm.me>
 Date: 2022-09-06
-Usage: csv-to-palo.py path/to/file
+Usage: csv-to-palo.py [-p PROCESSES] [-m MAX_ENTRIES] path/to/file
+       csv-to-palo.py --wsa HOST --palo HOST --wsa-command CMD -C WSA[=PALO] [-C ...]
 Description: Quick script to reformat the output of WSA custom URLs
 to be accepted by Palo Alto custom URL category imports.
- 
-Wouldn't it be nice to output this directly from the WSA using netmiko? :^)
+
+The export is streamed, so multi-GB files never sit in memory. Entries are
+normalized (scheme, port and userinfo dropped, host lowercased, WSA .domain
+turned into domain and *.domain), deduplicated and written to
+output-NAME-1.EXT, output-NAME-2.EXT, ... with at most MAX_ENTRIES per file,
+one file per custom URL category.
+
+With --wsa the categories come straight off the WSA over SSH instead, go
+through the same normalizer and are pushed to the Palo Alto custom URL
+categories over the XML API in batches. A content hash per category is kept
+locally so a category that hasn't changed since the last push is skipped.
 """
- 
+
+import argparse
+import functools
+import getpass
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import string
 import sys
- 
- 
+import time
+from multiprocessing import Pool
+from xml.sax.saxutils import escape
+
+from netmiko import ConnectHandler
+
+from panapi import PanApi
+
+
+# Schemes seen in WSA exports, stripped since PAN-OS URL entries have none.
+SCHEMES = ('http://', 'https://', 'ftp://')
+
+# Characters allowed in a host label; * and ^ are PAN-OS wildcard tokens when they are a whole label.
+HOST_CHARACTERS = set(string.ascii_lowercase + string.digits + '-_')
+
+# Longest entry PAN-OS accepts in a custom URL category.
+MAX_LENGTH = 255
+
+# Entries handed to a worker process at a time.
+BATCH_SIZE = 10000
+
+# Custom URL categories live in vsys1 of a standalone firewall.
+URL_CATEGORY_XPATH = "/config/devices/entry[@name='localhost.localdomain']/vsys/entry[@name='vsys1']/profiles/custom-url-category"
+
+# Names PAN-OS accepts for an object, which also keeps them safe inside an xpath literal.
+CATEGORY_NAME = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_. -]*$")
+
+
+def read_entries(file, block_size=1 << 20):
+    # Yield the raw entries of a WSA export, which are comma separated and may all sit on one huge line.
+    # Reads fixed size blocks so memory stays flat whatever the line length.
+    carry = ''
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        fields = (carry + block).replace('\n', ',').split(',')
+        carry = fields.pop()
+        for field in fields:
+            yield field
+    yield carry
+
+
+def normalize(entry):
+    # Turn one WSA entry into the PAN-OS entries it stands for.
+    # Returns (entries, None), or ([], reason) if PAN-OS can't take it.
+    entry = entry.strip().strip('"\'').strip()
+    if not entry:
+        return [], None
+
+    if '://' in entry:
+        lower = entry.lower()
+        for scheme in SCHEMES:
+            if lower.startswith(scheme):
+                entry = entry[len(scheme):]
+                break
+
+    host, slash, path = entry.partition('/')
+    host = host.rsplit('@', 1)[-1].split(':', 1)[0].lower().rstrip('.')
+
+    # WSA .example.com means example.com and every subdomain of it.
+    if host.startswith('.'):
+        host = host.lstrip('.')
+        hosts = [host, '*.' + host]
+    else:
+        hosts = [host]
+
+    labels = host.split('.')
+    if not host or host in ('*', '^'):
+        return [], "no host"
+    for label in labels:
+        if label not in ('*', '^') and (not label or not set(label) <= HOST_CHARACTERS):
+            return [], "bad host label " + repr(label)
+
+    entries = [host + slash + path for host in hosts]
+    if len(entries[-1]) > MAX_LENGTH:
+        return [], "longer than " + str(MAX_LENGTH) + " characters"
+
+    return entries, None
+
+
+def get_positions(entry, bits, hashes):
+    # Bloom filter bit positions of an entry, from one digest by double hashing.
+    digest = hashlib.blake2b(entry.encode(), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], 'big')
+    step = int.from_bytes(digest[8:], 'big') | 1
+    return [(first + i * step) & (bits - 1) for i in range(hashes)]
+
+
+def normalize_batch(batch, bits, hashes):
+    # Normalize a batch of raw entries, in a worker process when sharding.
+    # Duplicates within the batch are dropped here and the filter positions hashed here,
+    # leaving the parent only the bit tests.
+    entries = {}
+    rejected = []
+    count = 0
+    for raw in batch:
+        normalized, reason = normalize(raw)
+        if reason is not None:
+            rejected.append((raw.strip(), reason))
+        count += len(normalized)
+        for entry in normalized:
+            if entry not in entries:
+                entries[entry] = get_positions(entry, bits, hashes)
+
+    return list(entries.items()), count, rejected
+
+
+def batched(iterable, size):
+    # Group an iterable into lists of size items.
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_normalized(raw_entries, seen, pool, stats):
+    # Generator pipeline: raw entries in, new normalized entries out, in input order.
+    # Normalization runs on pool when there is one; counts are added to stats as batches come back.
+    worker = functools.partial(normalize_batch, bits=seen.bits, hashes=seen.hashes)
+    batches = batched(raw_entries, BATCH_SIZE)
+    results = pool.imap(worker, batches) if pool is not None else map(worker, batches)
+
+    for entries, count, skipped in results:
+        for raw, reason in skipped:
+            print("Skipped " + raw + ": " + reason, file=sys.stderr)
+        stats['skipped'] += len(skipped)
+        stats['entries'] += count
+        for entry, positions in entries:
+            if seen.add(positions):
+                yield entry
+
+
+class SeenFilter:
+    # Bloom filter of entries already written, so dedupe memory is fixed whatever the export size.
+    # A false positive drops an entry; the odds are printed at the end and --dedupe-mb lowers them.
+    # The size is rounded down to a power of two so positions are a mask rather than a modulo.
+
+    def __init__(self, size_mb, hashes=7):
+        self.array = bytearray(1 << (max(1, size_mb) * 1024 * 1024).bit_length() - 1)
+        self.bits = len(self.array) * 8
+        self.hashes = hashes
+        self.count = 0
+
+    def add(self, positions):
+        # Returns True if the entry with these positions wasn't seen before.
+        new = False
+        for bit in positions:
+            mask = 1 << (bit & 7)
+            if not self.array[bit >> 3] & mask:
+                self.array[bit >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+        return new
+
+    def false_positive_rate(self):
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+
+class SplitWriter:
+    # Write entries as they come, moving to a new file every max_entries entries.
+
+    def __init__(self, prefix, extension, max_entries):
+        self.prefix = prefix
+        self.extension = extension
+        self.max_entries = max_entries
+        self.files = []
+        self.file = None
+        self.count = 0
+
+    def write(self, entry):
+        if self.file is None or self.count == self.max_entries:
+            self.close()
+            name = self.prefix + "-" + str(len(self.files) + 1) + self.extension
+            self.file = open(name, 'w')
+            self.files.append(name)
+            self.count = 0
+        self.file.write(entry + '\n')
+        self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def convert_file(args, pool):
+    # Original mode: WSA export file in, category sized output files out.
+    directory, name = os.path.split(args.input_file)
+    stem, extension = os.path.splitext(name)
+    writer = SplitWriter(os.path.join(directory, "output-" + stem), extension, args.max_entries)
+    seen = SeenFilter(args.dedupe_mb)
+    stats = {'entries': 0, 'skipped': 0}
+
+    with open(args.input_file, 'r') as file:
+        try:
+            for entry in iter_normalized(read_entries(file), seen, pool, stats):
+                writer.write(entry)
+        finally:
+            writer.close()
+
+    print("{} entries, {} duplicates, {} skipped, {} written to {} file(s).".format(
+        stats['entries'], stats['entries'] - seen.count, stats['skipped'], seen.count, len(writer.files)))
+    for name in writer.files:
+        print("    " + name)
+    print("Dedupe false positive odds {:.2e}.".format(seen.false_positive_rate()))
+
+
+def get_content_hash(entries):
+    # Hash of a category's entries, in order, to tell whether it changed since the last push.
+    return hashlib.sha256("\n".join(entries).encode()).hexdigest()
+
+
+def load_hash_cache(path):
+    # Content hash per Palo Alto category as of the last push.
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_hash_cache(path, hashes):
+    temp = path + ".tmp"
+    with open(temp, 'w') as f:
+        json.dump(hashes, f, indent=1, sort_keys=True)
+    os.replace(temp, path)
+
+
+def get_category_xpath(name):
+    # Names are checked against CATEGORY_NAME up front, so they never carry a quote into the literal.
+    return URL_CATEGORY_XPATH + "/entry[@name='" + name + "']"
+
+
+def push_category(palo, name, entries, batch_size):
+    # Replace the custom URL category with entries, batch_size members per XML API call.
+    # The first call rewrites the whole entry, the following ones append to its list.
+    # Returns the number of calls made.
+    xpath = get_category_xpath(name)
+    members = ["<member>" + escape(entry) + "</member>" for entry in entries]
+
+    palo.edit(xpath, '<entry name="' + escape(name) + '"><type>URL List</type><list>' + "".join(members[:batch_size]) + "</list></entry>")
+    calls = 1
+    for start in range(batch_size, len(members), batch_size):
+        palo.set(xpath + "/list", "".join(members[start:start + batch_size]))
+        calls += 1
+
+    return calls
+
+
+def sync_categories(wsa, palo, categories, cache_path, pool, args):
+    # WSA category output -> normalizer -> Palo Alto categories, skipping any whose content hash is unchanged.
+    # A WSA category too big for one Palo Alto category spills into NAME-2, NAME-3, ...
+    hashes = {} if args.force else load_hash_cache(cache_path)
+    results = []
+    for wsa_name, palo_name in categories:
+        start = time.monotonic()
+        try:
+            output = wsa.send_command(args.wsa_command.format(category=wsa_name), read_timeout=600)
+        except Exception as e:
+            message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+            results.append([wsa_name, palo_name, 0, 0, "FAILED", time.monotonic() - start, message])
+            continue
+
+        seen = SeenFilter(args.dedupe_mb)
+        stats = {'entries': 0, 'skipped': 0}
+        entries = list(iter_normalized(read_entries(io.StringIO(output)), seen, pool, stats))
+        del output
+
+        parts = [entries[i:i + args.max_entries] for i in range(0, len(entries), args.max_entries)] or [[]]
+        for number, part in enumerate(parts, 1):
+            name = palo_name if number == 1 else palo_name + "-" + str(number)
+            content_hash = get_content_hash(part)
+            if hashes.get(name) == content_hash:
+                results.append([wsa_name, name, len(part), 0, "Unchanged", time.monotonic() - start, ""])
+                continue
+            try:
+                calls = push_category(palo, name, part, args.api_batch)
+            except Exception as e:
+                message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+                results.append([wsa_name, name, len(part), 0, "FAILED", time.monotonic() - start, message])
+                continue
+            hashes[name] = content_hash
+            save_hash_cache(cache_path, hashes)
+            results.append([wsa_name, name, len(part), calls, "Pushed", time.monotonic() - start, ""])
+
+        results += delete_spills(palo, wsa_name, palo_name, len(parts) + 1, hashes, cache_path)
+
+    return results
+
+
+def delete_spills(palo, wsa_name, palo_name, first, hashes, cache_path):
+    # Delete the spill categories from NAME-first up that a bigger version of the category left behind.
+    # Spills are numbered without gaps, so the first one missing on the firewall ends the run.
+    results = []
+    number = first
+    while True:
+        start = time.monotonic()
+        name = palo_name + "-" + str(number)
+        try:
+            if not palo.exists(get_category_xpath(name)):
+                break
+            palo.delete(get_category_xpath(name))
+        except Exception as e:
+            message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+            results.append([wsa_name, name, 0, 0, "FAILED", time.monotonic() - start, message])
+            break
+        hashes.pop(name, None)
+        save_hash_cache(cache_path, hashes)
+        results.append([wsa_name, name, 0, 2, "Deleted", time.monotonic() - start, ""])
+        number += 1
+
+    return results
+
+
+def print_results(results):
+    print()
+    print("{:<24} {:<24} {:>8} {:>6}  {:<10} {:>8}  {}".format("WSA CATEGORY", "PALO ALTO CATEGORY", "ENTRIES", "CALLS", "STATUS", "TIME", "ERROR"))
+    for wsa_name, palo_name, entries, calls, status, elapsed, error in results:
+        print("{:<24} {:<24} {:>8} {:>6}  {:<10} {:>7.1f}s  {}".format(wsa_name, palo_name, entries, calls, status, elapsed, error))
+
+
 def main():
-    # Import the argument as the input file location.
-    input_file = sys.argv[1]
-    output_file = "output-" + input_file
-    entries = []
- 
-    with open(input_file, 'r') as file:
-        for line in file:
-            data = line.split(', ')
-            for line in data:
-                entries.append(line)
- 
-    with open(output_file, 'w') as output:
-        for line in entries:
-            output.write(line + '\n')
+    # Create the parser and arguments.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_file", nargs='?', help="WSA custom URL export, unless pulling straight from the WSA.")
+    parser.add_argument("-m", "--max-entries", type=int, default=100000, metavar='',
+            help="Entries per output file, i.e. per custom URL category (default 100000).")
+    parser.add_argument("-p", "--processes", type=int, default=1, metavar='',
+            help="Processes normalizing entries in parallel (default 1).")
+    parser.add_argument("--dedupe-mb", type=int, default=64, metavar='',
+            help="Memory for the dedupe filter in MB (default 64).")
+    pipeline = parser.add_argument_group("WSA to Palo Alto pipeline")
+    pipeline.add_argument("--wsa", metavar='HOST',
+            help="Pull the categories from this WSA over SSH and push them to --palo, no files involved.")
+    pipeline.add_argument("--palo", metavar='HOST', help="Palo Alto firewall receiving the categories.")
+    pipeline.add_argument("-u", "--username", default=getpass.getuser(), metavar='',
+            help="Username on both devices (default the current user).")
+    pipeline.add_argument("-C", "--category", action="append", default=[], metavar='WSA[=PALO]',
+            help="WSA custom category to copy, optionally renamed on the Palo Alto. Can be repeated.")
+    pipeline.add_argument("--wsa-command", metavar='',
+            help="WSA command printing a category's URLs, {category} standing for its name.")
+    pipeline.add_argument("--wsa-device-type", default="generic", metavar='',
+            help="Netmiko device type for the WSA (default generic).")
+    pipeline.add_argument("--wsa-port", type=int, default=22, metavar='', help="WSA SSH port (default 22).")
+    pipeline.add_argument("--api-batch", type=int, default=500, metavar='',
+            help="URLs per XML API call (default 500).")
+    pipeline.add_argument("--api-port", type=int, metavar='',
+            help="XML API port (default 443, or 80 with --api-http).")
+    pipeline.add_argument("--api-http", action="store_true",
+            help="Use plain HTTP for the XML API, e.g. against a lab or stand-in server.")
+    pipeline.add_argument("-k", "--insecure", action="store_true",
+            help="Don't verify the XML API certificate.")
+    pipeline.add_argument("--cache", metavar='',
+            help="Content hash cache (default csv-to-palo_WSA_PALO.json).")
+    pipeline.add_argument("-f", "--force", action="store_true",
+            help="Push every category even if its content hash is unchanged.")
+    args = parser.parse_args()
+
+    if args.wsa is None and args.input_file is None:
+        parser.error("give an input file, or --wsa and --palo")
+    if args.wsa is not None and (args.palo is None or not args.category or args.wsa_command is None):
+        parser.error("--wsa needs --palo, --wsa-command and at least one --category")
+
+    pool = Pool(args.processes) if args.processes > 1 else None
+    try:
+        if args.wsa is None:
+            convert_file(args, pool)
+            return
+
+        categories = [(name.partition('=')[0].strip(), (name.partition('=')[2] or name.partition('=')[0]).strip()) for name in args.category]
+        for _, palo_name in categories:
+            if not CATEGORY_NAME.match(palo_name):
+                parser.error("bad Palo Alto category name " + repr(palo_name) + ", use letters, digits, spaces, _ . and -")
+        api_scheme = "http" if args.api_http else "https"
+        api_port = args.api_port or (80 if args.api_http else 443)
+        cache_path = args.cache or "csv-to-palo_" + args.wsa + "_" + args.palo + ".json"
+
+        # Device info.
+        wsa = {
+                'device_type':  args.wsa_device_type,
+                'host':         args.wsa,
+                'port':         args.wsa_port,
+                'username':     args.username,
+                'password':     getpass.getpass("WSA password: "),
+                }
+        palo_password = getpass.getpass("Palo Alto password: ")
+
+        palo = PanApi(args.palo, api_port, api_scheme, not args.insecure)
+        palo.keygen(args.username, palo_password)
+
+        # Initiate the SSH connection.
+        net_connect = ConnectHandler(**wsa)
+        try:
+            results = sync_categories(net_connect, palo, categories, cache_path, pool, args)
+        finally:
+            # Disconnect the SSH connection.
+            net_connect.disconnect()
+
+        print_results(results)
+        # The candidate config is left uncommitted, same as pasync.
+        print("Review and commit the candidate config on " + args.palo + ".")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 if __name__ == "__main__":
     main()
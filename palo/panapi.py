@@ -0,0 +1,72 @@
+"""
+Description: Minimal PAN-OS XML API client shared by pasync.py and csv-to-palo.py.
+Calls are POSTed with the key from keygen, and a response that isn't a
+success raises ValueError with the firewall's message.
+"""
+
+import shutil
+import ssl
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+
+
+class PanApi:
+    # Minimal PAN-OS XML API client.
+    # Large exports are streamed to disk instead of being held in memory.
+
+    def __init__(self, host, port=443, scheme="https", verify=True, timeout=300):
+        self.url = scheme + "://" + host + ":" + str(port) + "/api/"
+        self.key = None
+        self.context = None
+        if scheme == "https" and not verify:
+            # Firewalls usually run with a self-signed management certificate.
+            self.context = ssl.create_default_context()
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+        self.timeout = timeout
+
+    def open(self, params):
+        # POST keeps big elements out of the URL.
+        if self.key is not None:
+            params = dict(params, key=self.key)
+        data = urllib.parse.urlencode(params).encode()
+        return urllib.request.urlopen(self.url, data=data, timeout=self.timeout, context=self.context)
+
+    def request(self, params):
+        # Send a call and return the parsed response, raising on anything but success.
+        with self.open(params) as response:
+            root = ET.parse(response).getroot()
+        if root.get('status') != "success":
+            message = " ".join(text.strip() for text in root.itertext() if text.strip())
+            raise ValueError("XML API " + params.get('type', "") + " " + params.get('action', "") + " failed: " + message)
+        return root
+
+    def keygen(self, username, password):
+        # Trade the credentials for an API key used by every other call.
+        root = self.request({'type': "keygen", 'user': username, 'password': password})
+        self.key = root.findtext("result/key")
+
+    def export(self, xpath, path):
+        # Stream the running config under xpath straight to path.
+        with self.open({'type': "config", 'action': "show", 'xpath': xpath}) as response:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(response, f, 1024 * 1024)
+
+    def edit(self, xpath, element):
+        # Replace the node at xpath with element.
+        self.request({'type': "config", 'action': "edit", 'xpath': xpath, 'element': element})
+
+    def set(self, xpath, element):
+        # Merge element into the candidate config under xpath.
+        self.request({'type': "config", 'action': "set", 'xpath': xpath, 'element': element})
+
+    def exists(self, xpath):
+        # Whether the candidate config has a node at xpath.
+        root = self.request({'type': "config", 'action': "get", 'xpath': xpath})
+        result = root.find("result")
+        return result is not None and len(result) > 0
+
+    def delete(self, xpath):
+        # Remove the node at xpath from the candidate config.
+        self.request({'type': "config", 'action': "delete", 'xpath': xpath})
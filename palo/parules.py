@@ -0,0 +1,318 @@
+#!/bin/python3
+
+"""
+Usage: python parules.py BACKUP [-q "FROM TO SOURCE DESTINATION PROTOCOL/PORT"] [-Q FILE] [-s]
+Description: Offline security rule lookup and shadow analysis for PAN-OS.
+BACKUP is a set format config such as the security_policies_backup_*.conf
+written by pasync.py, so nothing here touches a firewall.
+
+Every dimension of the rulebase (source, destination, service) is cut into
+elementary intervals at the rule boundaries, each interval holding a bitset
+of the rules covering it; zones and applications get a bitset per name.
+A lookup is a bisect per dimension and an AND of the bitsets, the first
+matching rule being the lowest bit. Shadow analysis ANDs the bitsets over
+each rule's ranges through a segment tree, giving every earlier rule that
+covers it completely without comparing rules pairwise.
+"""
+
+import argparse
+import ipaddress
+import os
+import sys
+import time
+
+# The interval and bitset engine is shared with fortinet/forti.py.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ruleindex import ANY_ADDRESS, ANY_SERVICE, PROTOCOLS, Dimension, Resolver, complement, get_address_key, split_line
+
+# Services every firewall has without them being in the config.
+PREDEFINED_SERVICES = {
+        'service-http':     [('tcp', '80,8080')],
+        'service-https':    [('tcp', '443')],
+        }
+
+# Actions that let the traffic through, anything else blocks it.
+ALLOW_ACTIONS = ('allow',)
+
+
+def get_values(tokens):
+    # Values of an attribute, a single token or a [ list ].
+    return [token for token in tokens if token not in ("[", "]")]
+
+
+def parse_address(value):
+    # Interval of an ip-netmask, ip-range or literal address, None if it's neither.
+    try:
+        if "-" in value:
+            low, high = (ipaddress.ip_address(address.strip()) for address in value.split("-", 1))
+            if low.version != high.version or low > high:
+                return None
+            return get_address_key(low), get_address_key(high)
+        network = ipaddress.ip_network(value, strict=False)
+        return get_address_key(network.network_address), get_address_key(network.broadcast_address)
+    except ValueError:
+        return None
+
+
+def parse_ports(protocol, ports):
+    # Service intervals of a protocol and a port list like 80,443,8000-8080.
+    number = PROTOCOLS.get(protocol)
+    if number is None:
+        return []
+    intervals = []
+    for port in ports.split(","):
+        low, _, high = port.strip().partition("-")
+        intervals.append((number << 16 | int(low), number << 16 | int(high or low)))
+
+    return intervals
+
+
+def parse_config(file):
+    # Objects and rules of a set format config.
+    # Returns addresses, groups, services, service groups and the rules in rulebase order.
+    addresses = {}
+    address_groups = {}
+    services = dict((name, []) for name in PREDEFINED_SERVICES)
+    for name, definitions in PREDEFINED_SERVICES.items():
+        for protocol, ports in definitions:
+            services[name] += parse_ports(protocol, ports)
+    service_groups = {}
+    rules = {}
+
+    for line in file:
+        line = line.strip()
+        if not line.startswith("set "):
+            continue
+        tokens = split_line(line)
+        if len(tokens) < 4:
+            continue
+
+        if tokens[1] == "address" and len(tokens) >= 5 and tokens[3] in ("ip-netmask", "ip-range"):
+            addresses[tokens[2]] = parse_address(tokens[4])
+        elif tokens[1] == "address" and tokens[3] in ("fqdn", "ip-wildcard"):
+            addresses[tokens[2]] = None
+        elif tokens[1] == "address-group" and tokens[3] == "static":
+            address_groups[tokens[2]] = get_values(tokens[4:])
+        elif tokens[1] == "address-group" and tokens[3] == "dynamic":
+            address_groups[tokens[2]] = None
+        elif tokens[1] == "service" and len(tokens) >= 7 and tokens[3] == "protocol" and tokens[5] == "port":
+            services.setdefault(tokens[2], []).extend(parse_ports(tokens[4], tokens[6]))
+        elif tokens[1] == "service-group" and tokens[3] == "members":
+            service_groups[tokens[2]] = get_values(tokens[4:])
+        elif tokens[1:4] == ["rulebase", "security", "rules"] and len(tokens) >= 7:
+            rule = rules.setdefault(tokens[4], {'name': tokens[4]})
+            rule[tokens[5]] = get_values(tokens[6:])
+
+    return addresses, address_groups, services, service_groups, list(rules.values())
+
+
+class NameBits:
+    # Bitset of rules per zone or application name; rules on any are in every name's bitset.
+
+    def __init__(self, rule_names):
+        self.any = 0
+        self.names = {}
+        for bit, names in enumerate(rule_names):
+            if "any" in names:
+                self.any |= 1 << bit
+            else:
+                for name in names:
+                    self.names[name] = self.names.get(name, 0) | 1 << bit
+
+    def lookup(self, name):
+        return self.any | self.names.get(name, 0)
+
+    def covering(self, names, everyone):
+        # Rules whose names include all of names; only rules on any cover a rule on any.
+        if "any" in names:
+            return everyone & self.any
+        result = everyone
+        for name in names:
+            result &= self.lookup(name)
+
+        return result
+
+
+class RuleIndex:
+    # Indexed rulebase, rule N being bit N of every bitset.
+
+    def __init__(self, config):
+        addresses, address_groups, services, service_groups, rules = parse_config(config)
+        address_resolver = Resolver(addresses, address_groups)
+        service_resolver = Resolver(services, service_groups)
+        self.rules = rules
+
+        sources = []
+        destinations = []
+        ports = []
+        self.enabled = 0
+        self.conditional = 0
+        self.app_default = 0
+        self.allow = 0
+        for bit, rule in enumerate(rules):
+            rule['unresolved'] = []
+            for field, target, negate in (('source', sources, 'negate-source'), ('destination', destinations, 'negate-destination')):
+                names = rule.get(field, ["any"])
+                if "any" in names:
+                    intervals = ANY_ADDRESS
+                else:
+                    intervals, unresolved = address_resolver.resolve(names, parse_address)
+                    rule['unresolved'] += unresolved
+                    if unresolved:
+                        intervals = ANY_ADDRESS
+                    elif rule.get(negate) == ["yes"]:
+                        intervals = complement(intervals, ANY_ADDRESS)
+                target.append(intervals)
+
+            names = rule.get('service', ["any"])
+            if "any" in names or "application-default" in names:
+                intervals = ANY_SERVICE
+                if "application-default" in names:
+                    self.app_default |= 1 << bit
+            else:
+                intervals, unresolved = service_resolver.resolve(names)
+                rule['unresolved'] += unresolved
+                if unresolved:
+                    intervals = ANY_SERVICE
+            ports.append(intervals)
+
+            if rule.get('disabled') != ["yes"]:
+                self.enabled |= 1 << bit
+            if rule.get('action', ["allow"])[0] in ALLOW_ACTIONS:
+                self.allow |= 1 << bit
+            # Unresolved objects were widened to any, users and URL categories aren't indexed at all.
+            if rule['unresolved'] or rule.get('source-user', ["any"]) != ["any"] or rule.get('category', ["any"]) != ["any"]:
+                self.conditional |= 1 << bit
+
+        self.everyone = (1 << len(rules)) - 1
+        self.sources = Dimension(sources, tree=True)
+        self.destinations = Dimension(destinations, tree=True)
+        self.services = Dimension(ports, tree=True)
+        self.from_zones = NameBits([rule.get('from', ["any"]) for rule in rules])
+        self.to_zones = NameBits([rule.get('to', ["any"]) for rule in rules])
+        self.applications = NameBits([rule.get('application', ["any"]) for rule in rules])
+        self.source_intervals = sources
+        self.destination_intervals = destinations
+        self.service_intervals = ports
+
+    def lookup(self, from_zone, to_zone, source, destination, protocol, port, application=None):
+        # First rule matching the flow, and the earlier rules that might match first depending on
+        # the application, user, URL category or unresolved objects.
+        # Returns (rule or None, [rules]).
+        candidates = (self.enabled
+                      & self.from_zones.lookup(from_zone)
+                      & self.to_zones.lookup(to_zone)
+                      & self.sources.lookup(get_address_key(ipaddress.ip_address(source)))
+                      & self.destinations.lookup(get_address_key(ipaddress.ip_address(destination)))
+                      & self.services.lookup(PROTOCOLS.get(protocol, 0) << 16 | port))
+        if application is not None:
+            candidates &= self.applications.lookup(application)
+            certain = candidates & ~(self.conditional | self.app_default)
+        else:
+            certain = candidates & ~(self.conditional | self.app_default) & self.applications.any
+
+        first = certain & -certain
+        maybe = candidates & (first - 1) if first else candidates
+        rules = [self.rules[bit] for bit in iter_bits(maybe)]
+
+        return (self.rules[first.bit_length() - 1] if first else None), rules
+
+    def shadows(self):
+        # Rules an earlier enabled rule covers completely, with that rule and whether the actions agree.
+        # Returns [(rule, earlier rule, "redundant" or "shadowed")].
+        # Conditional rules never count as covering anything.
+        coverers = self.enabled & ~self.conditional
+        found = []
+        for bit, rule in enumerate(self.rules):
+            if not self.enabled >> bit & 1:
+                continue
+            covering = coverers & ((1 << bit) - 1)
+            if not self.app_default >> bit & 1:
+                covering &= ~self.app_default
+            covering = self.from_zones.covering(rule.get('from', ["any"]), covering)
+            covering = self.to_zones.covering(rule.get('to', ["any"]), covering)
+            covering = self.applications.covering(rule.get('application', ["any"]), covering)
+            covering = self.sources.covering(self.source_intervals[bit], covering)
+            covering = self.destinations.covering(self.destination_intervals[bit], covering)
+            covering = self.services.covering(self.service_intervals[bit], covering)
+            if not covering:
+                continue
+
+            earlier = (covering & -covering).bit_length() - 1
+            same = (self.allow >> bit & 1) == (self.allow >> earlier & 1)
+            found.append((rule, self.rules[earlier], "redundant" if same else "shadowed"))
+
+        return found
+
+
+def iter_bits(bits):
+    # Positions of the set bits, lowest first.
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+def parse_query(query):
+    # FROM TO SOURCE DESTINATION PROTOCOL/PORT [APPLICATION]
+    fields = query.split()
+    if len(fields) not in (5, 6):
+        raise ValueError("expected FROM TO SOURCE DESTINATION PROTOCOL/PORT [APPLICATION]: " + query)
+    protocol, _, port = fields[4].partition("/")
+    application = fields[5] if len(fields) == 6 else None
+    return fields[0], fields[1], fields[2], fields[3], protocol.lower(), int(port or 0), application
+
+
+def main():
+    # Create the parser and arguments.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("backup", type=argparse.FileType('r'), help="Set format config, e.g. a pasync backup.")
+    parser.add_argument("-q", "--query", action="append", default=[], metavar='',
+            help='Flow to look up as "FROM TO SOURCE DESTINATION PROTOCOL/PORT [APPLICATION]". Can be repeated.')
+    parser.add_argument("-Q", "--queries", type=argparse.FileType('r'), metavar='',
+            help="File with one flow per line, same format as --query.")
+    parser.add_argument("-s", "--shadow", action="store_true",
+            help="Report rules covered completely by an earlier rule.")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    index = RuleIndex(args.backup)
+    print("Indexed {} rules in {:.2f}s ({} source, {} destination, {} service intervals).".format(
+        len(index.rules), time.monotonic() - start, index.sources.size, index.destinations.size, index.services.size))
+
+    queries = list(args.query)
+    if args.queries is not None:
+        queries += [line.strip() for line in args.queries if line.strip() and not line.startswith("#")]
+    if queries:
+        print()
+        print("{:<60} {:<30} {:>8}  {}".format("FLOW", "RULE", "TIME", "MAY MATCH FIRST"))
+    for query in queries:
+        try:
+            flow = parse_query(query)
+            start = time.perf_counter()
+            rule, maybe = index.lookup(*flow)
+            elapsed = time.perf_counter() - start
+        except ValueError as e:
+            print(str(e), file=sys.stderr)
+            continue
+        print("{:<60} {:<30} {:>6.0f}us  {}".format(query, rule['name'] if rule else "(default deny)", elapsed * 1e6,
+                                                  " ".join(other['name'] for other in maybe)))
+
+    if args.shadow:
+        start = time.monotonic()
+        shadows = index.shadows()
+        print()
+        print("{:<30} {:<30} {}".format("RULE", "COVERED BY", "KIND"))
+        for rule, earlier, kind in shadows:
+            print("{:<30} {:<30} {}".format(rule['name'], earlier['name'], kind))
+        print("{} of {} rules covered by an earlier rule, found in {:.2f}s.".format(
+            len(shadows), len(index.rules), time.monotonic() - start))
+
+    unresolved = sorted(set(name for rule in index.rules for name in rule['unresolved']))
+    if unresolved:
+        print("Couldn't resolve " + ", ".join(unresolved) + "; rules using them are treated as conditional.", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
@@ -3,9 +3,51 @@
 import argparse
 import datetime
 import getpass
+import hashlib
+import io
+import ipaddress
+import itertools
+import json
+import os
+import queue
+import re
+import shlex
 import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from netmiko import ConnectHandler, NetmikoTimeoutException, ReadTimeout
+
+from panapi import PanApi
+
+# Objects live in vsys1 of a standalone firewall.
+VSYS_XPATH = "/config/devices/entry[@name='localhost.localdomain']/vsys/entry[@name='vsys1']"
+
+# Containers synced by the XML API engine, relative to VSYS_XPATH.
+# Referenced objects come before whatever references them, security rules last.
+API_OBJECTS = ['tag', 'address', 'address-group', 'service', 'service-group', 'application-filter', 'application-group', 'external-list', 'profiles', 'profile-group', 'hip-objects', 'hip-profiles', 'rulebase/security/rules']
+
+# Words that make up the object type of a set line, one unless listed.
+TYPE_WORDS = {
+        'profiles': 2,
+        'rulebase': 3,
+        }
+
+# Push order for incremental syncs: addresses before groups before rules.
+TYPE_ORDER = ['tag', 'address', 'service', 'external-list', 'application-filter', 'hip-objects', 'address-group', 'service-group', 'application-group', 'hip-profiles', 'profiles', 'url-filtering', 'profile-group', 'group-mapping', 'log-settings', 'application-filtering', 'rulebase security rules']
+
+# Attributes that hold a member list. PAN-OS prints a one-member list without brackets,
+# so these are compared as lists whatever they look like.
+LIST_ATTRIBUTES = ('static', 'members', 'member', 'from', 'to', 'source', 'destination', 'source-user', 'application', 'service', 'category', 'tag', 'hip-profiles', 'source-hip', 'destination-hip')
+
+# Address object attributes that can be folded into an aggregate; anything else (tags) pins the object.
+AGGREGATE_ATTRIBUTES = ('ip-netmask', 'ip-range', 'description')
+
+# Output that means PAN-OS rejected the line before it.
+PUSH_ERRORS = ("Invalid syntax", "Unknown command", "Server error", "Validation Error", "is not a valid reference", "is already in use", "Error:")
 
-from netmiko import ConnectHandler
 
 def send_operation(net_connect, command):
     # Operational mode command formatting.
@@ -17,14 +59,41 @@ def send_config(net_connect, command):
     output = (net_connect.send_command(command, expect_string=r"#"))
     return output
 
-def get_source_config(source):
+def prepare_session(net_connect):
     # Set the CLI output mode to set.
     command = "set cli config-output-format set"
-    send_operation(source, command)
+    send_operation(net_connect, command)
 
     # Enter configure mode.
     command = "configure"
-    send_config(source, command)
+    send_config(net_connect, command)
+
+
+def collect_objects(net_connect, work, results):
+    # Worker: keep taking objects off the queue until it's empty.
+    # Each session only ever runs on its own thread.
+    while True:
+        try:
+            index, command = work.get_nowait()
+        except queue.Empty:
+            return
+        start = time.monotonic()
+        try:
+            output = send_config(net_connect, command)
+            error = None
+        except Exception as e:
+            output = ""
+            error = e
+        results[index] = (command, output, time.monotonic() - start, error)
+
+
+def get_source_config(sources, label=""):
+    # Collect the objects over every session in sources at once.
+    prepare = [threading.Thread(target=prepare_session, args=(source,)) for source in sources]
+    for thread in prepare:
+        thread.start()
+    for thread in prepare:
+        thread.join()
 
     # This was the XPATH syntax I was playing with, but it is much easier to use the set format.
     #command = "show config running xpath devices/entry[@name='localhost.localdomain']/vsys/entry[@name='vsys1']/"
@@ -39,17 +108,29 @@ def get_source_config(source):
 
     objects = ['service', 'service-group', 'address', 'address-group', 'group-mapping', 'tag', 'profile-group', 'profiles', 'url-filtering', 'hip-objects', 'hip-profiles', 'application-filtering', 'log-settings', 'external-list']
 
-    # Get each object and save to config.
-    config = ''
-    for object in objects:
-        command = "show " + object
-        config += send_config(source, command)
+    # Security policies go last, after the objects they reference.
+    commands = ["show " + object for object in objects] + ["show rulebase security"]
+
+    work = queue.Queue()
+    for index, command in enumerate(commands):
+        work.put((index, command))
+    results = [None] * len(commands)
 
-    # Get security policies and add to the previous config.
-    command = "show rulebase security"
-    config += send_config(source, command)
+    workers = [threading.Thread(target=collect_objects, args=(source, work, results)) for source in sources]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
 
-    return config
+    # Assemble in the original order no matter which session finished first.
+    config = io.StringIO()
+    for command, output, elapsed, error in results:
+        if error is not None:
+            raise error
+        print(label + "{:<30} {:>8.1f}s {:>8} lines".format(command, elapsed, output.count("\n")))
+        config.write(output)
+
+    return config.getvalue()
 
 
 def backup_config(config):
@@ -60,55 +141,652 @@ def backup_config(config):
             f.write(line)
 
 
-def set_destination_config(destination, config):
+def get_push_errors(chunk, output):
+    # Walk the echoed output and pin every error on the line it followed.
+    commands = set(chunk)
+    failed = []
+    current = None
+    for line in output.splitlines():
+        text = line.split("# ", 1)[1].strip() if "# " in line else line.strip()
+        if text in commands:
+            current = text
+        elif current is not None and any(error in line for error in PUSH_ERRORS):
+            failed.append((current, line.strip()))
+            current = None
+
+    return failed
+
+
+def iter_lines(text):
+    # Lines of text one at a time, without splitting the whole config into a second copy.
+    return (match.group(0) for match in re.finditer(r"[^\n]+", text))
+
+
+def send_chunk(destination, chunk, read_timeout, retries=3, label=""):
+    # Write a chunk in one go and read back one prompt per line, so the output returned is exactly the chunk's.
+    # A timing based read stops at the first quiet gap and lets a slow chunk's output bleed into the next.
+    # A line that outlasts read_timeout is waited on again rather than resent, the lines after it are
+    # already queued on the firewall. Returns the output and whether a wait timed out.
+    destination.write_channel("".join(line + destination.RETURN for line in chunk))
+    prompt = re.escape(destination.base_prompt) + r"#"
+    output = ""
+    slow = False
+    for line in chunk:
+        for retry in range(retries + 1):
+            try:
+                output += destination.read_until_pattern(pattern=prompt, read_timeout=read_timeout)
+                break
+            except (ReadTimeout, NetmikoTimeoutException):
+                if retry == retries:
+                    raise
+                slow = True
+                print(label + "Firewall is slow, still waiting on: " + line)
+
+    return output, slow
+
+
+def set_destination_config(destination, lines, chunk_size=200, target=5.0, label=""):
+    # Stream set lines to the destination in chunks and check every line's echo for errors.
+    # Chunks shrink when one takes longer than target seconds or times out, and grow back when it's fast.
+    # lines can be any iterable, so a big config is never copied into a second list.
+    # Returns the number of lines pushed and the (line, error) pairs the firewall rejected.
     # Enter configure mode.
     command = "configure"
     send_config(destination, command)
 
-    # Send downloaded config.
-    send_config(destination, config)
+    lines = (line.strip() for line in lines)
+    lines = (line for line in lines if line)
+    size = chunk_size
+    pushed = 0
+    failed = []
+    start = time.monotonic()
+    while True:
+        chunk = list(itertools.islice(lines, size))
+        if not chunk:
+            break
+
+        chunk_start = time.monotonic()
+        output, slow = send_chunk(destination, chunk, max(60.0, target * 4), label=label)
+        elapsed = time.monotonic() - chunk_start
+
+        failed += get_push_errors(chunk, output)
+        pushed += len(chunk)
+        print(label + "Pushed {} lines, {:.0f} lines/s, {} failed.".format(
+            pushed, pushed / max(time.monotonic() - start, 0.001), len(failed)))
+
+        if slow or elapsed > target:
+            size = max(1, size // 2)
+            if slow:
+                print(label + "Backing off to {} lines per chunk.".format(size))
+        elif elapsed < target / 4:
+            size = min(chunk_size, size * 2)
+
+    elapsed = time.monotonic() - start
+    print(label + "Pushed {} lines in {:.1f}s ({:.0f} lines/s), {} failed.".format(
+        pushed, elapsed, pushed / max(elapsed, 0.001), len(failed)))
+    for line, error in failed:
+        print(label + "  " + line)
+        print(label + "    " + error)
+
+    return pushed, failed
+
+
+def split_set_line(line):
+    # Tokens of a set line, honouring quoted names and descriptions.
+    # shlex is slow, most lines have nothing for it to do.
+    if '"' not in line and "'" not in line and "\\" not in line:
+        return line.split()
+    try:
+        return shlex.split(line)
+    except ValueError:
+        return line.split()
+
+
+def quote(token):
+    # Quote a token again if it has to be for the CLI.
+    if not token or " " in token or '"' in token:
+        return '"' + token.replace('"', '\\"') + '"'
+    return token
+
+
+def parse_records(config):
+    # Group the set lines of a config into records keyed by (type, name).
+    # Returns {(type, name): [lines]} in the order the objects first appear.
+    records = {}
+    for line in config.splitlines():
+        line = line.strip()
+        if not line.startswith("set "):
+            continue
+        tokens = split_set_line(line)
+        words = TYPE_WORDS.get(tokens[1], 1)
+        if len(tokens) < words + 2:
+            continue
+        key = (" ".join(tokens[1:words + 1]), tokens[words + 1])
+        records.setdefault(key, []).append(line)
+
+    return records
+
+
+def get_fingerprint(lines):
+    # Content hash of a record, independent of the line order.
+    return hashlib.sha1("\n".join(sorted(lines)).encode()).hexdigest()
+
+
+def get_rank(object_type):
+    # Position of a type in TYPE_ORDER so dependencies are pushed first.
+    for rank, prefix in enumerate(TYPE_ORDER):
+        if object_type == prefix or object_type.startswith(prefix + " "):
+            return rank
+    return len(TYPE_ORDER) - 1
+
+
+def split_attribute(line):
+    # Split a set line into its attribute path and its value.
+    # The value is the trailing [ list ] as a set of members, or the last token.
+    tokens = split_set_line(line)[1:]
+    if tokens and tokens[-1] == "]" and "[" in tokens:
+        start = len(tokens) - 1 - tokens[::-1].index("[")
+        return tuple(tokens[:start]), set(tokens[start + 1:-1])
+    return tuple(tokens[:-1]), tokens[-1] if tokens else ""
+
+
+def is_list(path, *values):
+    # Whether an attribute holds a member list, from its name or from either side being bracketed.
+    return (path and path[-1] in LIST_ATTRIBUTES) or any(isinstance(value, set) for value in values)
+
+
+def get_members(value):
+    # Members of a list attribute, a bare value being a one-member list.
+    return value if isinstance(value, set) else set([value])
+
+
+def diff_record(old_lines, new_lines):
+    # Commands that turn an object from old_lines into new_lines.
+    # Attributes that went away are deleted first, members dropped from lists are deleted one by one
+    # after the sets, so a list never goes through empty.
+    # Setting a list only adds members, so a list is set again only when it gained some.
+    old = dict(split_attribute(line) for line in old_lines)
+    new = dict(split_attribute(line) for line in new_lines)
+    deletes = []
+    sets = []
+    removals = []
+    for path, value in old.items():
+        if path not in new:
+            deletes.append("delete " + " ".join(quote(token) for token in path))
+        elif is_list(path, value, new[path]):
+            for member in sorted(get_members(value) - get_members(new[path])):
+                removals.append("delete " + " ".join(quote(token) for token in path) + " " + quote(member))
+    for line in new_lines:
+        path, value = split_attribute(line)
+        if path not in old:
+            sets.append(line)
+        elif is_list(path, old[path], value):
+            if get_members(value) - get_members(old[path]):
+                sets.append(line)
+        elif old[path] != value:
+            sets.append(line)
+
+    return deletes + sets + removals
+
+
+def order_records(keys, records):
+    # Sort keys by type rank, and inside a type put objects after the ones they reference (nested groups).
+    keys = sorted(keys, key=lambda key: get_rank(key[0]))
+    wanted = set(keys)
+    ordered = []
+    placed = set()
+
+    def place(key, seen):
+        if key in placed or key in seen:
+            return
+        seen.add(key)
+        for line in records[key]:
+            for token in split_set_line(line)[3:]:
+                reference = (key[0], token)
+                if reference in wanted and reference != key:
+                    place(reference, seen)
+        placed.add(key)
+        ordered.append(key)
+
+    for key in keys:
+        place(key, set())
+
+    return ordered
+
+
+def diff_configs(baseline, records, delete=True):
+    # Commands that bring the destination from baseline to records, in dependency order.
+    # Returns the commands and the created/changed/deleted counts.
+    created = [key for key in records if key not in baseline]
+    changed = [key for key in records if key in baseline and get_fingerprint(records[key]) != get_fingerprint(baseline[key])]
+    deleted = [key for key in baseline if key not in records] if delete else []
+
+    commands = []
+    rules = [key for key in records if key[0] == "rulebase security rules"]
+    positions = dict((key, position) for position, key in enumerate(rules))
+    for key in order_records(created + changed, records):
+        if key in baseline:
+            commands += diff_record(baseline[key], records[key])
+            continue
+        commands += records[key]
+        if key in positions:
+            # New rules land at the bottom, move them under the rule they follow at the source.
+            position = positions[key]
+            where = "after " + quote(rules[position - 1][1]) if position else "top"
+            commands.append("move rulebase security rules " + quote(key[1]) + " " + where)
+
+    # Deletes go the other way round, rules before the groups and objects they use.
+    for key in reversed(order_records(deleted, baseline)):
+        commands.append("delete " + key[0] + " " + quote(key[1]))
+
+    return commands, (len(created), len(changed), len(deleted))
+
+
+def get_interval(kind, value):
+    # Integer interval (version, low, high) of an ip-netmask or ip-range value, None if it isn't one.
+    try:
+        if kind == "ip-netmask":
+            # Host bits set (10.0.0.5/24) still mean the whole subnet.
+            address, _, prefix = value.partition("/")
+            address = ipaddress.ip_address(address)
+            bits = address.max_prefixlen
+            host_bits = bits - int(prefix) if prefix else 0
+            if not 0 <= host_bits <= bits:
+                return None
+            low = int(address) >> host_bits << host_bits
+            return address.version, low, low + (1 << host_bits) - 1
+        low, high = (ipaddress.ip_address(address.strip()) for address in value.split("-", 1))
+        if low.version != high.version or low > high:
+            return None
+        return low.version, int(low), int(high)
+    except ValueError:
+        return None
+
+
+def merge_intervals(intervals):
+    # Union of (low, high) intervals; overlapping and adjacent ones are joined.
+    merged = []
+    for low, high in sorted(intervals):
+        if merged and low <= merged[-1][1] + 1:
+            if high > merged[-1][1]:
+                merged[-1][1] = high
+        else:
+            merged.append([low, high])
+
+    return merged
+
+
+def interval_to_cidrs(low, high, bits):
+    # Fewest prefixes covering exactly low..high: each one as big as the alignment of low and the space left allow.
+    cidrs = []
+    while low <= high:
+        size = min((low & -low).bit_length() - 1 if low else bits, (high - low + 1).bit_length() - 1)
+        cidrs.append((low, bits - size))
+        low += 1 << size
+
+    return cidrs
+
+
+def aggregate_addresses(config):
+    # Collapse the IP members of every static address group into the fewest CIDRs covering the same addresses.
+    # Each group is aggregated on its own, so no group ever matches more than before.
+    # Members that aren't plain ip-netmask/ip-range objects (fqdn, tagged objects, nested groups) are kept as they are.
+    # Objects only used by the rewritten groups are dropped; objects used anywhere else stay.
+    # Returns the new config and the (groups, members before, members after, objects before, objects after) counts.
+    records = parse_records(config)
+    intervals = {}
+    objects = {}
+    for (object_type, name), lines in records.items():
+        if object_type != "address":
+            continue
+        objects[name] = lines
+        attributes = [split_set_line(line)[3:] for line in lines]
+        if all(len(tokens) == 2 and tokens[0] in AGGREGATE_ATTRIBUTES for tokens in attributes):
+            values = [tokens for tokens in attributes if tokens[0] != "description"]
+            if len(values) == 1:
+                interval = get_interval(*values[0])
+                if interval is not None:
+                    intervals[name] = interval
+
+    # Existing single-prefix objects are reused instead of creating an aggregate with the same value.
+    by_cidr = {}
+    for name, (version, low, high) in intervals.items():
+        size = high - low + 1
+        if size & (size - 1) == 0 and low % size == 0:
+            by_cidr.setdefault((version, low, size.bit_length() - 1), name)
+
+    # References to every object from outside the address records.
+    references = {}
+    for (object_type, name), lines in records.items():
+        if object_type == "address":
+            continue
+        for line in lines:
+            for token in split_set_line(line)[3:]:
+                references[token] = references.get(token, 0) + 1
+
+    rewritten = {}
+    created = {}
+    members_before = 0
+    members_after = 0
+    for (object_type, name), lines in records.items():
+        if object_type != "address-group":
+            continue
+        for line in lines:
+            path, members = split_attribute(line)
+            if path[2:] != ("static",):
+                continue
+            members = sorted(members) if isinstance(members, set) else [members]
+            kept = [member for member in members if member not in intervals]
+            ip_members = [member for member in members if member in intervals]
+            cidrs = []
+            for version, bits in ((4, 32), (6, 128)):
+                merged = merge_intervals((intervals[member][1], intervals[member][2]) for member in ip_members if intervals[member][0] == version)
+                for low, high in merged:
+                    cidrs += [(version, network, prefix) for network, prefix in interval_to_cidrs(low, high, bits)]
+            if len(cidrs) >= len(ip_members):
+                continue
+
+            aggregates = []
+            for version, network, prefix in cidrs:
+                cidr = (version, network, 128 - prefix if version == 6 else 32 - prefix)
+                if cidr not in by_cidr:
+                    address = str(ipaddress.ip_address(network))
+                    aggregate = "agg-" + address.replace(":", "_") + "_" + str(prefix)
+                    while aggregate in objects:
+                        aggregate += "_"
+                    by_cidr[cidr] = aggregate
+                    objects[aggregate] = ["set address " + aggregate + " ip-netmask " + address + "/" + str(prefix)]
+                    intervals[aggregate] = (version, network, network + (1 << cidr[2]) - 1)
+                    created[aggregate] = objects[aggregate]
+                aggregates.append(by_cidr[cidr])
+
+            new_members = kept + aggregates
+            rewritten[line] = "set address-group " + quote(name) + " static [ " + " ".join(quote(member) for member in new_members) + " ]"
+            members_before += len(members)
+            members_after += len(new_members)
+            for member in members:
+                references[member] -= 1
+            for member in new_members:
+                references[member] = references.get(member, 0) + 1
+
+    # Objects referenced before that nothing points at any more are dropped.
+    dropped = set(name for name in objects if name not in created and references.get(name, 1) == 0)
+    used_created = [name for name in created if references.get(name, 0) > 0]
+
+    output = []
+    inserted = False
+    for line in config.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("set address-group ") and not inserted:
+            # New aggregates go right before the first group so they exist before they're referenced.
+            for name in used_created:
+                output += created[name]
+            inserted = True
+        if stripped.startswith("set address "):
+            tokens = split_set_line(stripped)
+            if len(tokens) > 2 and tokens[2] in dropped:
+                continue
+        output.append(rewritten.get(stripped, line))
+    if not inserted:
+        for name in used_created:
+            output += created[name]
+
+    objects_before = len(objects) - len(created)
+    objects_after = objects_before - len(dropped) + len(used_created)
+    return "\n".join(output) + "\n", (len(rewritten), members_before, members_after, objects_before, objects_after)
+
+
+def load_sync_cache(path):
+    # Records as of the last sync, None if this pair was never synced.
+    try:
+        with open(path, 'r') as f:
+            return dict(((object_type, name), lines) for object_type, name, _, lines in json.load(f)['records'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_sync_cache(path, records):
+    # Keep what was just synced, fingerprints included, for the next incremental run.
+    cache = {'records': [[key[0], key[1], get_fingerprint(lines), lines] for key, lines in records.items()]}
+    temp = path + ".tmp"
+    with open(temp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(temp, path)
+
+
+def iter_exported(path):
+    # Yield the children of an exported container one at a time, as XML strings.
+    # Each child is dropped from the tree once serialized so memory stays flat.
+    # response > result > container > children
+    stack = []
+    root = None
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+                # Code 7 is "No such node", nothing of that kind is configured.
+                if root.get('status') != "success" and root.get('code') == "7":
+                    return
+                if root.get('status') != "success":
+                    raise ValueError("Export " + path + " failed.")
+            stack.append(elem)
+            continue
+        stack.pop()
+        if len(stack) == 3:
+            elem.tail = None
+            yield ET.tostring(elem, encoding="unicode")
+            stack[-1].remove(elem)
+
+
+def api_export(source, directory):
+    # Export every container from the source to directory.
+    # Returns the (container, path) pairs in push order.
+    os.makedirs(directory, exist_ok=True)
+    exports = []
+    for object in API_OBJECTS:
+        path = os.path.join(directory, object.replace("/", "-") + ".xml")
+        start = time.monotonic()
+        source.export(VSYS_XPATH + "/" + object, path)
+        print("{:<26} exported in {:>6.1f}s".format(object, time.monotonic() - start))
+        exports.append((object, path))
+
+    return exports
+
+
+def api_import(destination, exports, batch_size, label=""):
+    # Set every exported container on the destination in batches.
+    # Returns the number of entries pushed.
+    total = 0
+    for object, path in exports:
+        # The set goes to the container's parent, with the container itself as the element.
+        parent, container = (VSYS_XPATH + "/" + object).rsplit("/", 1)
+        start = time.monotonic()
+        count = 0
+        calls = 0
+        batch = []
+        for element in iter_exported(path):
+            batch.append(element)
+            count += 1
+            if len(batch) == batch_size:
+                destination.set(parent, "<" + container + ">" + "".join(batch) + "</" + container + ">")
+                calls += 1
+                batch = []
+        if batch:
+            destination.set(parent, "<" + container + ">" + "".join(batch) + "</" + container + ">")
+            calls += 1
+
+        print(label + "{:<26} {:>8} entries imported in {:>6.1f}s over {} calls".format(
+            object, count, time.monotonic() - start, calls))
+        total += count
+
+    return total
+
+
+def sync_destination(destination_firewall, source_config, exports, args):
+    # Push the source snapshot to one destination.
+    # Any failure ends up in the result instead of stopping the other destinations.
+    host = destination_firewall['host']
+    label = host + ": "
+    result = {'host': host, 'status': "OK", 'pushed': 0, 'failed': 0}
+    start = time.monotonic()
+    net_connect2 = None
+
+    try:
+        if args.api:
+            # The candidate config is left uncommitted, same as the CLI path.
+            destination = PanApi(host, args.api_port, args.api_scheme, not args.insecure)
+            destination.keygen(destination_firewall['username'], destination_firewall['password'])
+            result['pushed'] = api_import(destination, exports, args.api_batch, label)
+            return result
+
+        net_connect2 = ConnectHandler(**destination_firewall)
+
+        if args.incremental:
+            # Diff against the last sync of this pair, or the destination itself the first time.
+            # Objects are only deleted when we know we synced them.
+            cache_path = "pasync_" + args.source + "_" + host + ".json"
+            records = parse_records(source_config)
+            baseline = load_sync_cache(cache_path)
+            delete = baseline is not None
+            if baseline is None:
+                baseline = parse_records(get_source_config([net_connect2], label))
+            commands, (created, changed, deleted) = diff_configs(baseline, records, delete)
+            print(label + "{} objects: {} created, {} changed, {} deleted, {} commands to push.".format(
+                len(records), created, changed, deleted, len(commands)))
+
+            failed = []
+            if commands:
+                result['pushed'], failed = set_destination_config(net_connect2, commands, args.chunk_size, label=label)
+            # After a failed line the cache can't be trusted, the next run diffs against the destination again.
+            if not failed:
+                save_sync_cache(cache_path, records)
+            elif os.path.exists(cache_path):
+                os.remove(cache_path)
+        else:
+            # PUSH CONFIG TO DEST
+            result['pushed'], failed = set_destination_config(net_connect2, iter_lines(source_config),
+                                                              args.chunk_size, label=label)
+
+        result['failed'] = len(failed)
+        if failed:
+            result['status'] = "Lines failed"
+    except Exception as e:
+        message = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
+        print(label + message)
+        result['status'] = "Error: " + message
+    finally:
+        # Disconnect the SSH connection.
+        if net_connect2 is not None:
+            net_connect2.disconnect()
+        result['time'] = time.monotonic() - start
+
+    return result
+
+
+def print_results(results):
+    # Per-destination status and timing summary.
+    print()
+    print("{:<24} {:>10} {:>8} {:>8}  {}".format("DESTINATION", "PUSHED", "FAILED", "TIME", "STATUS"))
+    for result in results:
+        print("{:<24} {:>10} {:>8} {:>7.1f}s  {}".format(
+            result['host'], result['pushed'], result['failed'], result['time'], result['status']))
 
 
 def main():
     # Create the parser and arguments.
     parser = argparse.ArgumentParser()
     parser.add_argument("source", help="Source Firewall IP.")
-    parser.add_argument("destination", help="Destination Firewall IP.")
+    parser.add_argument("destination", help="Destination Firewall IP, or several separated by commas.")
     parser.add_argument("username", help="Username")
+    parser.add_argument("-s", "--sessions", type=int, default=4, metavar='',
+            help="Parallel SSH sessions used to collect the source config (default 4).")
+    parser.add_argument("-i", "--incremental", action="store_true",
+            help="Push only objects created, changed or deleted since the last sync.")
+    parser.add_argument("-c", "--chunk-size", type=int, default=200, metavar='',
+            help="Maximum set lines per chunk when pushing over the CLI (default 200).")
+    parser.add_argument("-g", "--aggregate", action="store_true",
+            help="Collapse the IP members of every address group into the fewest CIDRs before pushing.")
+    parser.add_argument("-a", "--api", action="store_true",
+            help="Sync over the XML API instead of the CLI.")
+    parser.add_argument("--api-batch", type=int, default=200, metavar='',
+            help="Entries per XML API set call (default 200).")
+    parser.add_argument("--api-port", type=int, metavar='',
+            help="XML API port (default 443, or 80 with --api-http).")
+    parser.add_argument("--api-http", action="store_true",
+            help="Use plain HTTP for the XML API, e.g. against a lab or stand-in server.")
+    parser.add_argument("-k", "--insecure", action="store_true",
+            help="Don't verify the XML API certificates.")
+    parser.add_argument("-w", "--workers", type=int, default=8, metavar='',
+            help="Maximum destinations pushed to at once (default 8).")
     args = parser.parse_args()
 
+    destinations = [host.strip() for host in args.destination.split(',') if host.strip()]
+    if args.aggregate and args.api:
+        parser.error("--aggregate works on the set lines of the CLI path, not with --api")
+    if args.incremental and args.api:
+        parser.error("--incremental diffs the set lines of the CLI path, not with --api")
+    args.api_scheme = "http" if args.api_http else "https"
+    args.api_port = args.api_port or (80 if args.api_http else 443)
+
+    # Every firewall shares the username, so only prompt once.
+    password = getpass.getpass()
+
     # Device info.
     source_firewall = {
             'device_type':  'paloalto_panos',
             'host':         args.source,
             'username':     args.username,
-            'password':     getpass.getpass(),
+            'password':     password,
             }
 
-    destination_firewall = {
-            'device_type':  'paloalto_panos',
-            'host':         args.destination,
-            'username':     args.username,
-            'password':     getpass.getpass(),
-            }
+    destination_firewalls = []
+    for host in destinations:
+        destination_firewall = {
+                'device_type':  'paloalto_panos',
+                'host':         host,
+                'username':     args.username,
+                'password':     password,
+                }
+        destination_firewalls.append(destination_firewall)
+
+    # DOWNLOAD CONFIG FROM SOURCE, once for every destination.
+    source_config = None
+    exports = None
+    start = time.monotonic()
+    if args.api:
+        source = PanApi(args.source, args.api_port, args.api_scheme, not args.insecure)
+        source.keygen(args.username, password)
 
+        # The exports double as the backup.
+        current_time = datetime.datetime.today().strftime("%Y_%m_%d_%H_%M")
+        exports = api_export(source, "security_policies_backup_" + str(current_time))
+    else:
+        # Initiate the SSH connections, several to the source to collect in parallel.
+        with ThreadPoolExecutor(max_workers=max(1, args.sessions)) as pool:
+            sources = list(pool.map(lambda _: ConnectHandler(**source_firewall), range(max(1, args.sessions))))
+        source_config = get_source_config(sources)
 
-    # Initiate the SSH connection.
-    net_connect1 = ConnectHandler(**source_firewall)
-    net_connect2 = ConnectHandler(**destination_firewall)
+        # Disconnect the SSH connections.
+        for net_connect1 in sources:
+            net_connect1.disconnect()
 
-    # DOWNLOAD CONFIG FROM SOURCE
-    source_config = get_source_config(net_connect1)
+        # SAVE TO FILE FOR DEBUG
+        backup_config(source_config)
 
-    # SAVE TO FILE FOR DEBUG
-    backup_config(source_config)
+        if args.aggregate:
+            # The backup above keeps the config as collected.
+            aggregate_start = time.monotonic()
+            source_config, (groups, members_before, members_after, objects_before, objects_after) = aggregate_addresses(source_config)
+            print("Aggregated {} address groups in {:.1f}s: {} members -> {}, {} address objects -> {}.".format(
+                groups, time.monotonic() - aggregate_start, members_before, members_after, objects_before, objects_after))
+    print("Collected source config in {:.1f}s.".format(time.monotonic() - start))
 
-    # PUSH CONFIG TO DEST
-    set_destination_config(net_connect2, source_config)
+    # PUSH CONFIG TO DEST, through a bounded worker pool.
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        results = list(pool.map(lambda firewall: sync_destination(firewall, source_config, exports, args),
+                                destination_firewalls))
 
-    # Disconnect the SSH connection.
-    net_connect1.disconnect()
-    net_connect2.disconnect()
+    print_results(results)
 
 
 if __name__ == "__main__":
@@ -1,31 +1,103 @@
 #!/bin/python3
 
 import argparse
+import csv
 import datetime
 import getpass
 import sys
+import time
 
 from netmiko import ConnectHandler
 
+# Load modes accepted by load config partial.
+MODES = ['merge', 'replace', 'append']
+
+# Output that means PAN-OS rejected the command.
+LOAD_ERRORS = ("Invalid syntax", "Unknown command", "Server error", "Validation Error", "does not exist", "Error:", "failed")
+
+
 def send_operation(net_connect, command):
     # Operational mode command formatting.
     output = (net_connect.send_command(command, expect_string=r">"))
     return output
 
-def send_config(net_connect, command):
+def send_config(net_connect, command, read_timeout=120):
     # Configuration mode command formatting.
-    output = (net_connect.send_command(command, expect_string=r"#"))
+    output = (net_connect.send_command(command, expect_string=r"#", read_timeout=read_timeout))
     return output
 
-def set_destination_config(destination, config):
+def read_manifest(file):
+    # Manifest lines are SOURCE_XPATH,DESTINATION_XPATH,FILE,MODE with MODE merge, replace or append.
+    # Quote an xpath with "" if it has a comma in it. Blank lines and lines starting with # are ignored.
+    jobs = []
+    for number, row in enumerate(csv.reader(file), 1):
+        if not row or not row[0].strip() or row[0].strip().startswith("#"):
+            continue
+        if len(row) != 4 or row[3].strip() not in MODES:
+            print("Line " + str(number) + ": expected SOURCE_XPATH,DESTINATION_XPATH,FILE,MODE with MODE one of " + ", ".join(MODES) + ".")
+            sys.exit(1)
+        jobs.append([field.strip() for field in row])
+
+    return jobs
+
+def get_errors(output):
+    # Lines of output that say the command didn't go through.
+    return [line.strip() for line in output.splitlines() if any(error in line for error in LOAD_ERRORS)]
+
+def commit_config(net_connect):
+    # Commit the candidate config, which can take minutes on a busy firewall.
+    start = time.monotonic()
+    output = send_config(net_connect, "commit", read_timeout=1800)
+    errors = get_errors(output)
+    if errors or "committed successfully" not in output:
+        print("Commit FAILED in {:.1f}s".format(time.monotonic() - start))
+        for error in errors:
+            print("    " + error)
+        return False
+
+    print("Commit OK in {:.1f}s".format(time.monotonic() - start))
+    return True
+
+def set_destination_config(destination, jobs, commit_every=0, commit=True):
+    # Run every job in one configure session, committing every commit_every jobs and once at the end.
+    # With commit_every at 0 there is a single commit after the last job, with commit off there is none.
+    # Returns a result per job.
     # Enter configure mode.
     command = "configure"
     send_config(destination, command)
 
-    # Send merge xpath command.
-    # make this an option to append merge or replace
-    command = "load config partial mode merge from-xpath " + source_xpath + " to-xpath " destination_xpath + " from " + filename
-    send_config(destination, command)
+    results = []
+    pending = []
+    for count, (source_xpath, destination_xpath, filename, mode) in enumerate(jobs, 1):
+        # Send merge xpath command.
+        command = "load config partial mode " + mode + " from-xpath " + source_xpath + " to-xpath " + destination_xpath + " from " + filename
+        start = time.monotonic()
+        output = send_config(destination, command, read_timeout=600)
+        errors = get_errors(output)
+        result = {'job': count, 'file': filename, 'mode': mode, 'xpath': destination_xpath,
+                  'time': time.monotonic() - start, 'status': "FAILED" if errors else "Loaded", 'errors': errors}
+        print("Job {}/{} {} {} -> {}: {} in {:.1f}s".format(count, len(jobs), mode, filename, destination_xpath, result['status'], result['time']))
+        results.append(result)
+        if not errors:
+            pending.append(result)
+
+        if commit and pending and (count == len(jobs) or (commit_every and len(pending) >= commit_every)):
+            committed = commit_config(destination)
+            for result in pending:
+                result['status'] = "Committed" if committed else "Commit failed"
+            pending = []
+
+    return results
+
+def print_results(results):
+    # Timing and result report per job.
+    print()
+    print("{:>4} {:<8} {:<24} {:>8}  {:<14} {}".format("JOB", "MODE", "FILE", "TIME", "STATUS", "DESTINATION XPATH"))
+    for result in results:
+        print("{:>4} {:<8} {:<24} {:>7.1f}s  {:<14} {}".format(
+            result['job'], result['mode'], result['file'], result['time'], result['status'], result['xpath']))
+        for error in result['errors']:
+            print("     " + error)
 
 
 def main():
@@ -33,8 +105,16 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("firewall", help="Firewall hostname or IP.")
     parser.add_argument("username", help="Username")
+    parser.add_argument("-m", "--manifest", type=argparse.FileType('r'), required=True,
+            help="CSV of SOURCE_XPATH,DESTINATION_XPATH,FILE,MODE jobs, FILE being a config saved on the firewall.")
+    parser.add_argument("-c", "--commit-every", type=int, default=0, metavar='',
+            help="Commit after this many loaded jobs instead of once at the end.")
+    parser.add_argument("-n", "--no-commit", action="store_true",
+            help="Load every job but leave the candidate config uncommitted.")
     args = parser.parse_args()
 
+    jobs = read_manifest(args.manifest)
+
     # Device info.
     firewall = {
             'device_type':  'paloalto_panos',
@@ -48,7 +128,12 @@ def main():
     net_connect = ConnectHandler(**firewall)
 
     # PUSH CONFIG TO DEST
-    set_destination_config(net_connect, source_config)
+    start = time.monotonic()
+    results = set_destination_config(net_connect, jobs, args.commit_every, commit=not args.no_commit)
+    print_results(results)
+    if args.no_commit:
+        print("Candidate config left uncommitted.")
+    print("{} jobs in {:.1f}s".format(len(jobs), time.monotonic() - start))
 
     # Disconnect the SSH connection.
     net_connect.disconnect()